@@ -42,6 +42,9 @@ function init_test_vars
     LSQ_MAKE_JOBS='lsq2'
                    #tatb' -- this test never worked
 
+    # Makefile tests of chimes_lsq.py solver options, run without DLARS
+    LSQ_SOLVER_JOBS='lsq-solvers'
+
 	MD_JOBS='carbon-penalty
 		 h2o-2bcheby
 		 h2o-2bcheby-genvel
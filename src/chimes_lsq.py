@@ -1,10 +1,19 @@
 import sys
 import numpy
 import scipy.linalg
+import scipy.sparse
 import math as m
 import subprocess
 import os
 import argparse
+import glob
+import hashlib
+import io
+import json
+import multiprocessing
+import threading
+import signal
+import shutil
 
 from numpy        import *
 from numpy.linalg import lstsq
@@ -33,26 +42,70 @@ def main():
     parser.add_argument("--algorithm",            type=str,      default='svd',           help='fitting algorithm')
     parser.add_argument("--dlasso_dlars_path",    type=str     , default=loc+'/../contrib/dlars/src/',              help='Path to DLARS and/or DLASSO solver')
     parser.add_argument("--alpha",                type=float,    default=1.0e-04,         help='Lasso regularization')
-    parser.add_argument("--b",                    type=str,      default='b.txt',         help='b (force) file')
+    parser.add_argument("--b",                    type=str,      default='b.txt',         help='b (force) file, or a comma-separated list of b files (or a multi-column b file) fit with one factorization')
     parser.add_argument("--cores",                type=int,      default=8,               help='DLARS number of cores')
     parser.add_argument("--eps",                  type=float,    default=1.0e-05,         help='svd regularization')
     parser.add_argument("--header",               type=str,      default='params.header', help='parameter file header')
     parser.add_argument("--map",                  type=str,      default='ff_groups.map', help='parameter file map')
     parser.add_argument("--nodes",                type=int,      default=1,               help='DLARS number of nodes')
-    parser.add_argument("--mpistyle",             type=str,      default="srun",          help='Command used to run an MPI job, e.g. srun, ibrun, mpriun, etc')
+    parser.add_argument("--mpistyle",             type=str,      default="srun",          help='Command used to run an MPI job: srun, ibrun, mpirun, mpiexec, or local (no MPI launcher)')
     parser.add_argument("--normalize",            type=str2bool, default=False,           help='Normalize DLARS calculation')
     parser.add_argument("--read_output",          type=str2bool, default=False,           help='Read output from previous DLARS run')
+    parser.add_argument("--dlars_walltime",       type=float,    default=0.0,             help='Wall-time limit of a DLARS/DLASSO run in minutes (0 = no limit)')
+    parser.add_argument("--dlars_progress",       type=float,    default=60.0,            help='Seconds between DLARS/DLASSO progress lines on stderr (0 = none)')
+    parser.add_argument("--dlars_checkpoint",     type=float,    default=30.0,            help='Minutes between copies of the DLARS/DLASSO restart files to dlars_checkpoints/ (0 = none)')
+    parser.add_argument("--dlars_resume",         type=str2bool, default=True,            help='Resume an unfinished DLARS/DLASSO run in the working directory from its newest complete restart file')
+    parser.add_argument("--dlars_scan",           type=str,      default="",              help='Run DLARS/DLASSO for several alpha values at once ("v1,v2,..." or log range "start:stop:num") and keep the lowest-BIC one')
+    parser.add_argument("--dlars_scan_jobs",      type=int,      default=0,               help='Concurrent --dlars_scan runs, sharing --nodes and --cores (0 = one per node, or one per alpha on a single node)')
     parser.add_argument("--restart_dlasso_dlars", type=str,      default="",              help='Determines whether dlasso or dlars job will be restarted. Argument is the restart file name ')
     parser.add_argument("--split_files",          type=str2bool, default=False,           help='LSQ code has split A matrix output.  Works DLARS.')
     parser.add_argument("--test_suite",           type=str2bool, default=False,           help='output for test suite')
     parser.add_argument("--weights",              type=str,      default="None",          help='weight file')
     parser.add_argument("--active",               type=str2bool, default=False,           help='is this a DLARS/DLASSO run from the active learning driver?')
     parser.add_argument("--folds",type=int, default=4,help="Number of CV folds")
+    parser.add_argument("--binary_cache",         type=str2bool, default=False,           help='Write .npy sidecar copies of A and b (.csr.npz for lsqr/lsmr), and the parsed header layout, next to the inputs to speed up later reads')
+    parser.add_argument("--svd_driver",           type=str,      default="gesdd",         help='SVD method: gesdd or gesvd (thin SVD of A), or qr (QR of A, then SVD of R; never forms U)')
+    parser.add_argument("--sweep",                type=str,      default="",              help='Sweep svd eps or ridge alpha from one factorization: a list "v1,v2,..." or log range "start:stop:num"')
+    parser.add_argument("--sweep_write",          type=str2bool, default=False,           help='After a sweep, write the parameter file for the lowest-BIC value')
+    parser.add_argument("--cv",                   type=str2bool, default=False,           help='Frame-grouped K-fold cross validation (--folds folds) before the full fit')
+    parser.add_argument("--ensemble",             type=int,      default=0,               help='Fit a bootstrap ensemble of this many members (frames resampled, grouped via --natoms) before the full fit')
+    parser.add_argument("--ensemble_dir",         type=str,      default="ensemble",      help='Directory for the --ensemble parameter files and statistics')
+    parser.add_argument("--natoms",               type=str,      default='natoms.txt',    help='Atoms per frame for each row of A (natoms.txt)')
+    parser.add_argument("--labels",               type=str,      default='b-labeled.txt', help='Labeled b file (b-labeled.txt)')
+    parser.add_argument("--sketch",               type=str,      default='countsketch',   help='Random projection for --algorithm=sketch: countsketch or gaussian')
+    parser.add_argument("--sketch_rows",          type=int,      default=0,               help='Rows in the sketched system (0 = 16 x parameters for countsketch, 4 x for gaussian)')
+    parser.add_argument("--sketch_iters",         type=int,      default=0,               help='LSQR refinement iterations against the full A after the sketch solve')
+    parser.add_argument("--iter_limit",           type=int,      default=0,               help='Iteration limit of the lsqr, lsmr and cg solvers (0 = 10 times the number of variables); the run stops if the default limit is reached')
+    parser.add_argument("--iter_tol",             type=float,    default=1.0e-10,         help='Relative tolerance of the lsqr, lsmr (atol and btol) and cg solvers')
+    parser.add_argument("--initial_params",       type=str,      default="",              help='Start the lsqr, lsmr, cg or lasso solver from this parameter file (same header) or x.txt')
+    parser.add_argument("--precision",            type=str,      default="double",        help='double, or mixed: float32 A with float64 iterative refinement (svd, ridge and cholesky)')
+    parser.add_argument("--precision_check",      type=str2bool, default=True,            help='With --precision=mixed, also solve in float64 and report the difference in RMS force error')
+    parser.add_argument("--sketch_check",         type=str2bool, default=False,           help='Also solve the exact normal equations and compare the sketch residual with it (a diagnostic; reads all of A again)')
+    parser.add_argument("--workers",              type=int,      default=0,               help='Number of worker processes for split-file and parallel solvers (0 = all available cores)')
+    parser.add_argument("--binary_out",           type=str,      default="",              help='Write A and b to this binary container (memory-mapped by later runs via --A); with --split_files, a directory for A.%%04d.bin containers of the split A files')
+    parser.add_argument("--append",               type=str2bool, default=False,           help='Update the saved fit state (--fit_state) with rows added to A since the last fit, then re-solve. Works with svd, tsqr, ridge and cholesky')
+    parser.add_argument("--fit_state",            type=str,      default='fit_state.npz', help='Fit state file read and written by --append')
+    parser.add_argument("--factor_cache",         type=str,      default="",              help='Directory of cached factorizations (SVD, normal equations, TSQR R), keyed by the contents of A, b and weights')
+    parser.add_argument("--factor_cache_size",    type=float,    default=4.0,             help='Size limit of --factor_cache in GB; least recently used entries are evicted')
+    parser.add_argument("--residuals",            type=str2bool, default=False,           help='Print RMS and max errors by atom type, stress component, energy, trajectory flag and (with --traj_list) trajectory file, from --labels')
+    parser.add_argument("--force_npy",            type=str2bool, default=False,           help='Also write the predicted forces to force.npy (binary)')
+    parser.add_argument("--frame_errors",         type=str,      default="",              help='Write per-frame force, stress and energy RMS errors, worst frames first, to this file')
+    parser.add_argument("--traj_list",            type=str,      default='traj_list.dat', help='MULTI trajectory list (traj_list.dat) naming the source file of each frame in --residuals and --frame_errors')
+    parser.add_argument("--prune",                type=str,      default="",              help='Also write a reduced parameter file to this file, without parameters smaller than --prune_tol (replaces post_proc_chimes_lsq.py)')
+    parser.add_argument("--prune_tol",            type=float,    default=1.0e-06,         help='Magnitude below which --prune removes triplet/quadruplet parameters and zeroes pair parameters')
+    parser.add_argument("--refit_support",        type=str,      default="",              help='Least-squares refit on the nonzero parameters of this x.txt or parameter file; svd or cholesky only, without --sweep or --append')
+    parser.add_argument("--mpi",                  type=str2bool, default=False,           help='Distribute the split A files over MPI ranks (mpi4py); rank 0 writes the output. Works with svd, ridge, cholesky and tsqr')
     
     # Actually parse the arguments
 
     args        = parser.parse_args()
     
+    # Several b files (targets) may be given; the first is read as b and the others are 
+    # added as columns once A and b are loaded
+    
+    B_FILES = args.b.split(",")
+    args.b  = B_FILES[0]
+    
     dlasso_dlars_path = args.dlasso_dlars_path
 
     #############################################
@@ -61,8 +114,66 @@ def main():
 
     # Algorithms requiring sklearn.
     sk_algos = ["lasso", "ridge", "lassolars", "lars", "ridgecv"] ;
+    
+    # Algorithms that can be solved from the normal equations accumulated over split A files.
+    normal_algos = ["svd", "ridge", "cholesky"]
+    
+    USE_NORMAL_EQNS = ((args.split_files and args.algorithm in normal_algos) or args.algorithm == "cholesky") and not args.append and args.precision != "mixed"
+    
+    # Algorithms that read A into a sparse (CSR) matrix.
+    sparse_algos = ["lsqr", "lsmr", "cg"]
+    
+    SPARSE_A = args.algorithm in sparse_algos
+    
+    # Algorithms that stream over A.txt or the split A files instead of reading A into memory.
+    USE_STREAMING   = (args.split_files and USE_NORMAL_EQNS) or args.algorithm in ("sketch", "tsqr") or args.append
+    
+    if args.refit_support != "" and (args.algorithm not in ("svd", "cholesky") or args.sweep != "" or args.append):
+        print ("Support refits (--refit_support) require the svd or cholesky algorithm, without --sweep or --append")
+        exit(1)
+        
+    if args.dlars_scan != "" and (args.algorithm not in ("dlars", "dlasso") or args.restart_dlasso_dlars != ""):
+        print ("Alpha scans (--dlars_scan) require the dlars or dlasso algorithm, without --restart_dlasso_dlars")
+        exit(1)
+        
+    if args.precision not in ("double", "mixed"):
+        print ("Unrecognized precision: " + args.precision + ". Recognized options are double and mixed")
+        exit(1)
+        
+    if args.precision == "mixed" and (args.algorithm not in ("svd", "ridge", "cholesky") or args.split_files or args.sweep != "" or args.append 
+                                      or args.cv or args.mpi or args.refit_support != ""):
+        print ("Mixed precision (--precision=mixed) requires one of the svd, ridge or cholesky algorithms, without split files, --sweep, --append, --cv, --mpi or --refit_support")
+        exit(1)
+        
+    if args.append and (args.algorithm not in ("svd", "tsqr", "ridge", "cholesky") or args.sweep != "" or args.cv or args.mpi):
+        print ("Incremental refits (--append) require one of the svd, tsqr, ridge or cholesky algorithms, without --sweep, --cv or --mpi")
+        exit(1)
+    
+    if args.workers < 1:
+        args.workers = count_workers()
+        
+    # In MPI mode each rank reads its own A.%04d.txt files.  Only rank 0 writes: stdout (the 
+    # parameter file) is discarded on the other ranks.
+        
+    MPI_COMM = None
+    
+    if args.mpi:
+    
+        if (not args.split_files) or args.algorithm not in ("svd", "ridge", "cholesky", "tsqr"):
+            print ("MPI mode requires --split_files=true and one of the svd, ridge, cholesky or tsqr algorithms")
+            exit(1)
+            
+        if args.factor_cache != "":
+            print ("The factorization cache (--factor_cache) cannot be used with --mpi")
+            exit(1)
+            
+        MPI_COMM = mpi_comm()
+        
+        if MPI_COMM.Get_rank() != 0:
+            sys.stdout        = open(os.devnull, "w")
+            args.binary_cache = False
 
-    if args.algorithm in sk_algos:
+    if args.algorithm in sk_algos and not USE_NORMAL_EQNS:
         from sklearn import linear_model
         from sklearn import preprocessing
         
@@ -75,28 +186,110 @@ def main():
         DO_WEIGHTING = False 
     else:
         DO_WEIGHTING = True
-        if ( not args.split_files ):
-            WEIGHTS= numpy.genfromtxt(args.weights,dtype='float')
+        if ( not args.split_files ) or USE_STREAMING or SPARSE_A:
+            WEIGHTS= load_matrix(args.weights, cache=False)
 
     #################################
     #   Process A and b matrices, sanity check weight dimensions
     #################################
 
-    # Use genfromtxt to avoid parsing large files. Note that the AL driver does not use split matrices
+    # Use load_matrix to parse large files in chunks. Note that the AL driver does not use split matrices
+    # A_IN_MEMORY is set when A has been read (or memory-mapped) as a whole.
+    
+    A_IN_MEMORY = False
     
-    if (args.active  and not args.split_files) or ((args.algorithm == "dlasso") and not args.split_files): 
+    if (args.active and not args.split_files and not args.append) or ((args.algorithm == "dlasso") and not args.split_files): 
     
         A      = numpy.zeros((1,1),dtype=float)
-        b      = numpy.genfromtxt(args.b, dtype='float') 
+        b      = load_matrix(args.b, cache=args.binary_cache) 
         np     = "undefined"
         nlines = b.shape[0]
+        
+    elif ( (not args.split_files) and (USE_STREAMING or args.precision == "mixed") ) :
+    
+        # A.txt is streamed by the solver and never read in as a whole (in mixed precision,
+        # it is read into single precision once the weights are applied, below)
+        
+        dim_file = os.path.join(os.path.dirname(args.A), "dim.txt")
+        
+        if is_binary_matrix(args.A):
+            (nlines, np) = open_binary_matrix(args.A)[0].shape
+        elif os.path.exists(dim_file):
+            (np, nlines) = read_dim_file(dim_file)[0:2]
+        else:
+            (nlines, np) = count_matrix_dims(args.A)
+            
+        A            = numpy.zeros((1,1),dtype=float)
+        b            = load_matrix(args.b, cache=args.binary_cache) 
+        MATRIX_FILES = [(args.A, 0, nlines, np)]
+        NMATRIX      = 1
+        
+        if ( nlines != b.shape[0] ):
+            print ("Error: the number of lines in the input files do not match\n")
+            exit(1) 
+
+    elif SPARSE_A and not args.read_output:
+    
+        # Only the nonzeros of A (or of all split A files, stacked in row order) are kept
+        
+        dim_file = os.path.join(os.path.dirname(args.A), "dim.txt")
+        
+        if args.split_files:
+            MATRIX_FILES = split_matrix_files()
+        elif is_binary_matrix(args.A):
+            MATRIX_FILES = [(args.A, 0) + open_binary_matrix(args.A)[0].shape]
+        elif os.path.exists(dim_file):
+            MATRIX_FILES = [(args.A, 0) + tuple(read_dim_file(dim_file)[1::-1])]
+        else:
+            MATRIX_FILES = [(args.A, 0) + count_matrix_dims(args.A)]
+            
+        A       = load_sparse_matrix(MATRIX_FILES, cache=args.binary_cache)
+        nlines  = A.shape[0] 
+        np      = A.shape[1] 
+        b       = load_matrix(args.b, cache=args.binary_cache) 
+        
+        A_IN_MEMORY = True
+        
+        if ( nlines != b.shape[0] ):
+            print ("Error: the number of lines in the input files do not match\n")
+            exit(1) 
+
+    elif ( (not args.split_files) and (not args.read_output) and is_binary_matrix(args.A) ) :
+    
+        # Binary container: A (and b, unless another b file was requested) are memory-mapped, 
+        # so the page cache is shared between repeated fits on the same matrix.
+        
+        A, b, dim = open_binary_matrix(args.A)
+        nlines    = A.shape[0] 
+        np        = A.shape[1] 
+        
+        A_IN_MEMORY = True
+        
+        if args.b != parser.get_default("b"):
+            b = load_matrix(args.b, cache=args.binary_cache) 
+            
+        if ( nlines != b.shape[0] ):
+            print ("Error: the number of lines in the input files do not match\n")
+            exit(1) 
 
     elif ( (not args.split_files) and (not args.read_output) ) :
-        A       = numpy.genfromtxt(args.A , dtype='float')
+        
+        # dim.txt is written next to A.txt by chimes_lsq and holds "param_count total"
+        
+        dim_file = os.path.join(os.path.dirname(args.A), "dim.txt")
+        
+        if os.path.exists(dim_file):
+            (np, nlines) = read_dim_file(dim_file)[0:2]
+            A = load_matrix(args.A, nlines, np, cache=args.binary_cache)
+        else:
+            A = load_matrix(args.A, cache=args.binary_cache)
+            
         nlines  = A.shape[0] 
         np      = A.shape[1] 
-        b       = numpy.genfromtxt(args.b, dtype='float') 
+        b       = load_matrix(args.b, cache=args.binary_cache) 
         nlines2 = b.shape[0] 
+        
+        A_IN_MEMORY = True
 
         if ( nlines != nlines2 ):
             print ("Error: the number of lines in the input files do not match\n")
@@ -105,6 +298,9 @@ def main():
             if np > nlines:
                 print ("Error: number of variables > number of equations")
                 exit(1)
+                
+        if args.binary_out != "":
+            write_binary_matrix(args.binary_out, A, b)
     else:
         
         if not args.read_output:
@@ -112,45 +308,162 @@ def main():
             line = next(dimf) 
             dim  = (int(x) for x in line.split())
             A    = numpy.zeros((1,1),dtype=float)           # Dummy A matrix - NOT read in.
-            b    = numpy.genfromtxt(args.b, dtype='float')  # Dummy b matrix - NOT read in.
+            b    = load_matrix(args.b, cache=args.binary_cache)  # Dummy b matrix - NOT read in.
             (np, nstart, nend, nlines) = dim
+            
+            if USE_STREAMING:
+                MATRIX_FILES = split_matrix_files()
+                NMATRIX      = len(MATRIX_FILES)
+                
+            if MPI_COMM is not None:
+                MATRIX_FILES = mpi_rank_files(MATRIX_FILES, MPI_COMM)
         else:
-            b      = numpy.genfromtxt(args.b, dtype='float') 
+            b      = load_matrix(args.b, cache=args.binary_cache) 
             np     = "undefined"
             nlines = b.shape[0]
             
+    # With split files, --binary_out names a directory (usually ".") for binary containers of 
+    # the split A files, which later runs memory-map in place of the text files
+    
+    NBINARY = 0
+    
+    if args.split_files and args.binary_out != "" and not args.read_output and (MPI_COMM is None or MPI_COMM.Get_rank() == 0):
+        NBINARY = write_split_binary_matrices(args.binary_out, b, args.workers)
+        
     # Sanity check weight dimensions        
     
-    if DO_WEIGHTING and not args.split_files:
+    if DO_WEIGHTING and (( not args.split_files ) or USE_STREAMING or SPARSE_A):
         if ( WEIGHTS.shape[0] != nlines ):
             print ("Wrong number of lines in WEIGHTS file")
             exit(1)  
 
+    # Several targets: the columns of b, from a list of b files or a multi-column b file. 
+    # They share the factorization of A, and each gets its own solution and output files.
+    
+    TARGETS = [b] + [load_matrix(b_file, cache=args.binary_cache) for b_file in B_FILES[1:]]
+    
+    if [b_file for (b_file, bt) in zip(B_FILES, TARGETS) if bt.shape[0] != b.shape[0]]:
+        print ("Error: the number of lines in the b files do not match\n")
+        exit(1)
+        
+    TARGET_NAMES = target_names(B_FILES, [1 if bt.ndim == 1 else bt.shape[1] for bt in TARGETS])
+    NTARGETS     = len(TARGET_NAMES)
+    
+    if NTARGETS > 1:
+    
+        b = numpy.column_stack(TARGETS)
+        
+        if (args.algorithm not in ("svd", "ridge", "cholesky") or args.sweep != "" or args.append or args.cv or args.mpi or args.refit_support != "" 
+            or args.precision != "double" or args.prune != "" or args.frame_errors != ""):
+            print ("Several b files (or b columns) require one of the svd, ridge or cholesky algorithms, without --sweep, --append, --cv, --mpi, --refit_support, --precision=mixed, --prune or --frame_errors")
+            exit(1)
+            
+    del TARGETS
+
+    # Input files that determine the factorizations below, for --factor_cache
+    
+    if USE_STREAMING:
+        FACTOR_FILES = [A_file for (A_file, start, nrows, ncols) in MATRIX_FILES]
+    else:
+        FACTOR_FILES = [args.A]
+        
+    FACTOR_FILES += B_FILES + ([args.weights] if DO_WEIGHTING else [])
+
+    #################################
+    # Frame-grouped cross validation
+    #################################
+    
+    # Runs on the unweighted A; each fold weights its own training rows.
+    
+    if args.cv:
+    
+        if (not A_IN_MEMORY) or args.algorithm not in ("svd", "ridge", "cholesky", "lasso", "lassolars"):
+            print ("Cross validation requires an in-memory A and one of the svd, ridge, cholesky, lasso or lassolars algorithms")
+            exit(1)
+            
+        FRAMES  = frame_index(load_matrix(args.natoms, cache=False), row_kinds(read_labels(args.labels)), nlines)
+        CV_RMS  = frame_cross_validation(A, b, WEIGHTS if DO_WEIGHTING else None, FRAMES, args.folds, args.algorithm, args.eps, args.alpha, args.svd_driver, args.workers)
+
+    #################################
+    # Bootstrap ensemble
+    #################################
+    
+    # As for cross validation, runs on the unweighted A; each member weights its own rows.
+    
+    if args.ensemble > 0:
+    
+        if (not A_IN_MEMORY) or args.algorithm not in ("svd", "ridge", "cholesky", "lasso", "lassolars") or args.ensemble < 2 or NTARGETS > 1:
+            print ("Bootstrap ensembles require an in-memory A, a single b, at least 2 members and one of the svd, ridge, cholesky, lasso or lassolars algorithms")
+            exit(1)
+            
+        with open(args.map, "r") as mapf:
+            ENS_MAP = mapf.readlines()
+            
+        FRAMES = frame_index(load_matrix(args.natoms, cache=False), row_kinds(read_labels(args.labels)), nlines)
+        ENS_X  = bootstrap_ensemble(A, b, WEIGHTS if DO_WEIGHTING else None, FRAMES, args.ensemble, args.algorithm, args.eps, args.alpha, args.svd_driver, args.workers)
+        ENS_Y  = dot(A, ENS_X)
+        
+        write_ensemble(args.ensemble_dir, ENS_X, ENS_Y, load_header_layout(args.header, cache=args.binary_cache), ENS_MAP)
+
+    #################################
+    # Starting point for iterative solvers
+    #################################
+    
+    # Coefficients of an earlier fit (e.g. the previous active learning generation), mapped
+    # onto x through the header layout
+    
+    X0 = None
+    
+    if args.initial_params != "":
+    
+        if args.algorithm not in sparse_algos + ["lasso"] or not A_IN_MEMORY:
+            print ("Initial parameters (--initial_params) require one of the lsqr, lsmr, cg or lasso algorithms")
+            exit(1)
+            
+        X0 = read_solution(args.initial_params, load_header_layout(args.header, cache=args.binary_cache), np)
+        
+        print ("! Initial parameters from " + args.initial_params)
+
     #################################
     # Apply weighting to A and b
     #################################
 
-    weightedA = None
-    weightedb = None
+    # A is scaled in place, one block of rows at a time, so no second copy of A is kept.  
+    # b stays unweighted for the residuals below; the solvers use weightedb.  Predictions
+    # are recovered from the weighted A after the solve (see unweight_predictions).
+
+    weightedb   = b
+    ZERO_WEIGHT = None
 
-    if DO_WEIGHTING and not args.split_files and not args.active  and not (args.algorithm == "dlasso"):
+    if DO_WEIGHTING and A_IN_MEMORY:
 
-        # This way requires too much memory for long A-mat's
-        # to avoid a memory error, we will do it the slow way:
+        if not (SPARSE_A or A.flags.writeable): # Read-only memory map; weighting needs a private copy
+            A = numpy.array(A)
 
-        weightedA = numpy.zeros((A.shape[0],A.shape[1]),dtype=float)
-        weightedb = numpy.zeros((A.shape[0],),dtype=float)
+        ZERO_WEIGHT = apply_row_weights(A, WEIGHTS)
+        weightedb   = b * (WEIGHTS if b.ndim == 1 else WEIGHTS[:, numpy.newaxis])
 
-        for i in range(A.shape[0]):     # Loop over rows (atom force components)
-            for j in range(A.shape[1]): # Loop over cols (variables in fit)
-                weightedA[i][j] = A[i][j]*WEIGHTS[i]
-                weightedb[i]    = b[i]   *WEIGHTS[i]
+    # Mixed precision: the weighted A is kept in float32, converted a block of rows at a time
+    
+    if args.precision == "mixed":
+    
+        A = load_float32_matrix(args.A, nlines, np, WEIGHTS if DO_WEIGHTING else None)
+        
+        if DO_WEIGHTING:
+            weightedb = b * WEIGHTS
 
 
     ################################                
     #  Header for output
     ################################
     
+    # With several targets, the header and solver output below are repeated at the top of 
+    # each target's parameter file
+    
+    if NTARGETS > 1:
+        STDOUT     = sys.stdout
+        sys.stdout = io.StringIO()
+        
     print ("! Date ", date.today())
     print ("!")
 
@@ -158,6 +471,18 @@ def main():
         print ("! Number of variables            = ", np)
 
     print ("! Number of equations            = ", nlines)
+    
+    if MPI_COMM is not None:
+        print ("! MPI ranks                      = ", MPI_COMM.Get_size())
+        
+    if NBINARY > 0:
+        print ("! Split A binary containers      = ", NBINARY, "in", args.binary_out)
+    
+    if args.cv:
+        print_cv_table(args.algorithm, CV_RMS)
+        
+    if args.ensemble > 0:
+        print_ensemble_summary(args.ensemble_dir, args.algorithm, ENS_X, ENS_Y)
 
     
                 
@@ -165,68 +490,267 @@ def main():
     # Solve the matrix equation
     #################################
 
-    if args.algorithm == 'svd':
+    if USE_NORMAL_EQNS:
+    
+        # Accumulate the np x np normal equations (weighted A)^T (weighted A) x = (weighted A)^T (weighted b),
+        # streaming over the split A files in parallel, or from the in-memory A.  Memory scales 
+        # with the number of parameters rather than the number of force components.
         
-        # Make the scipy call
+        if args.split_files:
+            print ("! Normal equations accumulated from %d split A files" % NMATRIX)
+            G, c = cached_factorization(args.factor_cache, args.factor_cache_size, "normal", FACTOR_FILES, 
+                                        lambda: accumulate_normal_equations(MATRIX_FILES, b, WEIGHTS if DO_WEIGHTING else None, args.workers, MPI_COMM))
+        else:
+            print ("! Normal equations formed from A")
+            G, c = cached_factorization(args.factor_cache, args.factor_cache_size, "normal", FACTOR_FILES, 
+                                        lambda: (dot(transpose(A), A), dot(transpose(A), weightedb)))
+            
+    if args.refit_support != "":
+    
+        # Unregularized refit on the parameters selected by an earlier (e.g. LASSO or DLARS) fit:
+        # the Gram matrix (accumulated, or cached with --factor_cache) or the columns of A 
+        # are restricted to the support.
         
-        print ('! svd algorithm used')
-        try:
-            if DO_WEIGHTING: # Then it's OK to overwrite weightedA.  It is not used to calculate y (predicted forces) below.
-                U,D,VT = scipy.linalg.svd(weightedA,overwrite_a=True)
-                Dmat   = array((transpose(weightedA)))
-            else:            #  Then do not overwrite A.  It is used to calculate y (predicted forces) below.
-                U,D,VT = scipy.linalg.svd(A,overwrite_a=False)
-                Dmat   = array((transpose(A)))  
-        except LinAlgError:
-            sys.stderr.write("SVD algorithm failed")
+        SUPPORT = numpy.flatnonzero(read_solution(args.refit_support, load_header_layout(args.header, cache=args.binary_cache), np) != 0.0)
+        
+        print ("! Least-squares refit on the nonzero parameters of " + args.refit_support)
+        print ("! Parameters in support          = ", len(SUPPORT))
+        
+        x = numpy.zeros(np)
+        
+        if USE_NORMAL_EQNS:
+            x[SUPPORT], nvars, eps = solve_normal_equations(G[numpy.ix_(SUPPORT, SUPPORT)], c[SUPPORT], args.algorithm, args.eps, args.alpha)
+        else:
+            D, VT, Utb = svd_factor(A[:, SUPPORT], weightedb, args.svd_driver)
+            x[SUPPORT], nvars, eps = svd_truncated_solution(D, VT, Utb, args.eps)
+            
+        if args.algorithm == 'svd':
+            print ('! svd algorithm used')
+            print ("! eps (= args.eps*dmax)          =  %11.4e" % eps)        
+            print ("! SVD regularization factor      = %11.4e" % args.eps)
+        else:
+            print ('! Cholesky factorization used')
+            
+        if args.split_files:
+            y = predict_split_files(MATRIX_FILES, x, args.workers, MPI_COMM)
+            
+    elif args.append:
+    
+        # Incremental refit: only rows added to the A file(s) since the saved fit are read, and
+        # QR-stacked onto the saved R factor.
+        
+        print ("! Incremental refit from fit state " + args.fit_state)
+        
+        STATE, NEW_ROWS = append_fit_state(args.fit_state, MATRIX_FILES, b, WEIGHTS if DO_WEIGHTING else None, np, args.workers)
+        
+        print ("! New equations factored         = ", NEW_ROWS)
+        
+        x, nvars, eps = solve_fit_state(STATE, args.algorithm, args.eps, args.alpha)
+        
+        if args.algorithm in ('svd', 'tsqr'):
+            print ('! ' + args.algorithm + ' algorithm used')
+            print ("! eps (= args.eps*dmax)          =  %11.4e" % eps)        
+            print ("! SVD regularization factor      = %11.4e" % args.eps)
+        elif args.algorithm == 'ridge':
+            print ('! ridge regression used')
+            print ("! Ridge alpha = %11.4e" % args.alpha)
+        else:
+            print ('! Cholesky factorization used')
+            
+    elif args.sweep != "":
+    
+        # Regularization sweep: factor once, then every eps/alpha value is a cheap filter on
+        # the singular values D, U^T b and VT.
+        
+        if args.algorithm not in ("svd", "ridge"):
+            print ("Regularization sweeps are only supported for the svd and ridge algorithms")
             exit(1)
             
-        # Process output
-
-        dmax = 0.0
-
-        for i in range(0,len(Dmat)):
-            if ( abs(D[i]) > dmax ) :
-                dmax = abs(D[i])
-
-            for j in range(0,len(Dmat[i])):
-                Dmat[i][j]=0.0
-
+        if USE_NORMAL_EQNS:
+            D, VT, Utb = normal_equations_svd(G, c)
+        else:
+            D, VT, Utb = cached_factorization(args.factor_cache, args.factor_cache_size, "svd-" + args.svd_driver, FACTOR_FILES, 
+                                              lambda: svd_factor(A, weightedb, args.svd_driver))
+            
+        sweep_vals = parse_sweep(args.sweep)
+        
+        X, NVARS, CUTOFFS = sweep_solutions(D, VT, Utb, args.algorithm, sweep_vals)
+        
+        if args.split_files:
+            Y = predict_split_files(MATRIX_FILES, X, args.workers, MPI_COMM)
+            
+            if Y is None:   # MPI rank other than 0
+                return 0
+        else:
+            Y = dot(A, X)
+            if ZERO_WEIGHT is not None:
+                Y = unweight_predictions(Y, X, WEIGHTS, ZERO_WEIGHT)
+        
+        best = print_sweep_table(args.algorithm, sweep_vals, Y, b, NVARS)
+        
+        if not args.sweep_write:
+            return 0
+            
+        x     = X[:,best]
+        y     = Y[:,best]
+        nvars = NVARS[best]
+        
+        if args.algorithm == 'svd':
+            args.eps = sweep_vals[best]
+            print ('! svd algorithm used')
+            print ("! eps (= args.eps*dmax)          =  %11.4e" % CUTOFFS[best])        
+            print ("! SVD regularization factor      = %11.4e" % args.eps)
+        else:
+            args.alpha = sweep_vals[best]
+            print ('! ridge regression used')
+            print ("! Ridge alpha = %11.4e" % args.alpha)
+            
+    elif args.precision == "mixed":
+    
+        # Single precision factorization, refined in double precision
+        
+        x, nvars, eps, istop, itn = fit_mixed_precision(A, weightedb, args.algorithm, args.eps, args.alpha, args.svd_driver, args.iter_limit, args.iter_tol)
+        
+        if args.algorithm == 'svd':
+            print ('! svd algorithm used')
+            print ("! eps (= args.eps*dmax)          =  %11.4e" % eps)        
+            print ("! SVD regularization factor      = %11.4e" % args.eps)
+        elif args.algorithm == 'ridge':
+            print ('! ridge regression used')
+            print ("! Ridge alpha = %11.4e" % args.alpha)
+        else:
+            print ('! Cholesky factorization used')
+            
+        print ("! Mixed precision: float32 A, float64 refinement by LSQR")
+        print ("! Refinement iterations          = ", itn)
+        print ("! Stopping reason (istop)        = ", istop)
+        
+        check_iterative_stop('lsqr', istop, itn, args.iter_limit)
+        
+        # Predictions use the (unweighted) float64 A, read back from file
+        
+        y = predict_split_files(MATRIX_FILES, x, args.workers)
+            
+        if args.precision_check:
+        
+            # Same fit in double precision: the svd needs A in memory, the normal equations 
+            # are accumulated from the A file a block of rows at a time
+            
+            if args.algorithm == 'svd':
+            
+                A64 = numpy.empty((nlines, np))
+                
+                for (row, chunk) in iter_matrix_chunks(args.A, nlines, np):
+                    A64[row:row+chunk.shape[0]] = chunk
+                    
+                x64 = fit_in_memory(A64 * WEIGHTS[:, numpy.newaxis] if DO_WEIGHTING else numpy.array(A64), weightedb, 'svd', args.eps, args.alpha, args.svd_driver)
+                y64 = A64.dot(x64)
+                
+                del A64
+            else:
+                G, c = accumulate_normal_equations(MATRIX_FILES, b, WEIGHTS if DO_WEIGHTING else None, args.workers)
+                x64  = solve_normal_equations(G, c, args.algorithm, args.eps, args.alpha)[0]
+                y64  = predict_split_files(MATRIX_FILES, x64, args.workers)
+                
+            rms32 = sqrt(numpy.mean((y - b) ** 2))
+            rms64 = sqrt(numpy.mean((y64 - b) ** 2))
+            
+            print ("! RMS force error (float64 fit)  = %11.4e" % rms64)
+            print ("! Mixed - float64 RMS force err  = %11.4e" % (rms32 - rms64))
+            print ("! Max rel. parameter difference  = %11.4e" % (numpy.abs(x - x64).max() / numpy.abs(x64).max()))
+            
+    elif USE_NORMAL_EQNS:
+    
+        x, nvars, eps = solve_normal_equations(G, c, args.algorithm, args.eps, args.alpha)
+        
+        if args.algorithm == 'svd':
+            print ('! svd algorithm used')
+            print ("! eps (= args.eps*dmax)          =  %11.4e" % eps)        
+            print ("! SVD regularization factor      = %11.4e" % args.eps)
+        elif args.algorithm == 'ridge':
+            print ('! ridge regression used')
+            print ("! Ridge alpha = %11.4e" % args.alpha)
+        else:
+            print ('! Cholesky factorization used')
+            
+        if args.split_files:
+            y = predict_split_files(MATRIX_FILES, x, args.workers, MPI_COMM)
+            
+    elif args.algorithm == 'svd':
+        
+        # Make the scipy call
+        
+        print ('! svd algorithm used')
+        
+        # Economy factorization: only D, VT and U^T b are kept.  A is not overwritten, since
+        # it is used to calculate y (predicted forces) below.
+        
+        D, VT, Utb = cached_factorization(args.factor_cache, args.factor_cache_size, "svd-" + args.svd_driver, FACTOR_FILES, 
+                                          lambda: svd_factor(A, weightedb, args.svd_driver))
+        
         # Cut off singular values based on fraction of maximum value as per numerical recipes.
         
-        eps=args.eps * dmax
-        nvars = 0
-
-        for i in range(0,len(D)):
-            if abs(D[i]) > eps:
-                Dmat[i][i]=1.0/D[i]
-                nvars += 1
+        x, nvars, eps = svd_truncated_solution(D, VT, Utb, args.eps)
 
         print ("! eps (= args.eps*dmax)          =  %11.4e" % eps)        
         print ("! SVD regularization factor      = %11.4e" % args.eps)
 
-        x=dot(transpose(VT),Dmat)
-
-        if DO_WEIGHTING:
-            x = dot(x,dot(transpose(U),weightedb))
+    elif args.algorithm == 'sketch':
+    
+        # Randomized sketch of the weighted system, streamed over A.txt or the split A files
+        
+        x, nvars, y = fit_sketch(MATRIX_FILES, b, WEIGHTS if DO_WEIGHTING else None, args.sketch, args.sketch_rows, args.sketch_iters, 
+                                 args.sketch_check, args.eps, args.svd_driver, args.workers)
+        
+    elif args.algorithm == 'tsqr':
+    
+        # Tall-skinny QR: each A file is factored by its own worker process and the small R 
+        # factors are merged in a reduction tree.
+        
+        print ("! TSQR algorithm used (%d blocks)" % NMATRIX)
+        
+        R, Qtb = cached_factorization(args.factor_cache, args.factor_cache_size, "tsqr", FACTOR_FILES, 
+                                      lambda: tsqr_factor(MATRIX_FILES, b, WEIGHTS if DO_WEIGHTING else None, args.workers, MPI_COMM))
+        
+        x, nvars, eps = solve_r_factor(R, Qtb, args.eps)
+        
+        print ("! eps (= args.eps*dmax)          =  %11.4e" % eps)        
+        print ("! SVD regularization factor      = %11.4e" % args.eps)
+        
+        y = predict_split_files(MATRIX_FILES, x, args.workers, MPI_COMM)
+        
+    elif SPARSE_A:
+    
+        # Iterative least squares on the sparse A; --alpha damps as in ridge regression
+        
+        x, istop, itn = fit_iterative(A, weightedb, args.algorithm, args.alpha, args.iter_limit, args.iter_tol, X0)
+        nvars         = np
+        
+        if args.algorithm == 'cg':
+            print ('! Conjugate gradient on the normal equations used (%d nonzeros in A)' % A.nnz)
         else:
-            x = dot(x,dot(transpose(U),b))
-
+            print ('! %s iterative solver used (%d nonzeros in A)' % (args.algorithm.upper(), A.nnz))
+        print ("! Damping alpha                  = %11.4e" % args.alpha)
+        print ("! Iterations                     = ", itn)
+        print ("! Stopping reason (istop)        = ", istop)
+        
+        check_iterative_stop(args.algorithm, istop, itn, args.iter_limit)
+        
     elif args.algorithm == 'ridge':
         print ('! ridge regression used')
         reg = linear_model.Ridge(alpha=args.alpha,fit_intercept=False)
 
         # Fit the data.
-        reg.fit(A,b)
+        reg.fit(A,weightedb)
 
-        x = reg.coef_
+        x = transpose(reg.coef_)    # One column per target
         nvars = np
         print ("! Ridge alpha = %11.4e" % args.alpha)
 
     elif args.algorithm == 'ridgecv':
         alpha_ar = [1.0e-06, 3.2e-06, 1.0e-05, 3.2e-05, 1.0e-04, 3.2e-04, 1.0e-03, 3.2e-03]
         reg = linear_model.RidgeCV(alphas=alpha_ar,fit_intercept=False,cv=args.folds)
-        reg.fit(A,b)
+        reg.fit(A,weightedb)
         print ('! ridge CV regression used')
         print ("! ridge CV alpha = %11.4e"  % reg.alpha_)
         x = reg.coef_
@@ -238,9 +762,17 @@ def main():
         
         print ('! Lasso regression used')
         print ('! Lasso alpha = %11.4e' % args.alpha)
-        reg   = linear_model.Lasso(alpha=args.alpha,fit_intercept=False,max_iter=100000)
-        reg.fit(A,b)
+        reg   = linear_model.Lasso(alpha=args.alpha,fit_intercept=False,max_iter=100000,warm_start=X0 is not None)
+        
+        if X0 is not None:
+            reg.coef_ = numpy.array(X0)
+            
+        reg.fit(A,weightedb)
         x     = reg.coef_
+        
+        if X0 is not None:
+            print ('! Lasso iterations = %d' % reg.n_iter_)
+            
         np    = count_nonzero_vars(x)
         nvars = np
 
@@ -251,12 +783,10 @@ def main():
         print ('! LARS implementation of LASSO used')
         print ('! LASSO alpha = %11.4e' % args.alpha)
 
-        if DO_WEIGHTING:
-            reg = linear_model.LassoLars(alpha=args.alpha,fit_intercept=False,fit_path=False,verbose=True,max_iter=100000, copy_X=False)
-            reg.fit(weightedA,weightedb)
-        else:
-            reg = linear_model.LassoLars(alpha=args.alpha,fit_intercept=False,fit_path=False,verbose=True,max_iter=100000)
-            reg.fit(A,b)
+        # LARS permutes the columns of X in place, so keep copy_X: A is needed for y below.
+
+        reg = linear_model.LassoLars(alpha=args.alpha,fit_intercept=False,fit_path=False,verbose=True,max_iter=100000)
+        reg.fit(A,weightedb)
         x       = reg.coef_[0]
         np      = count_nonzero_vars(x)
         nvars   = np
@@ -265,7 +795,38 @@ def main():
         
         # Make the DLARS or DLASSO call
 
-        x,y = fit_dlars(dlasso_dlars_path, args.nodes, args.cores, args.alpha, args.split_files, args.algorithm, args.read_output, args.weights, args.normalize, args.A , args.b ,args.restart_dlasso_dlars, args.mpistyle)
+        if args.dlars_scan != "":
+        
+            # Alpha scan: concurrent runs in dlars_scan/alpha_<alpha>; the lowest-BIC run 
+            # is copied to the working directory and written as the parameter file.
+            
+            scan_vals = parse_sweep(args.dlars_scan)
+            
+            scan_vals, DIRS, X, Y = scan_dlars(dlasso_dlars_path, args.nodes, args.cores, scan_vals, args.dlars_scan_jobs, args.split_files, args.algorithm, 
+                                               args.read_output, args.weights, args.normalize, args.A, args.b, args.mpistyle, args.dlars_walltime, args.dlars_progress)
+                                               
+            if A_IN_MEMORY:
+                Y = dot(A, X)
+                if ZERO_WEIGHT is not None:
+                    Y = unweight_predictions(Y, X, WEIGHTS, ZERO_WEIGHT)
+                    
+            NVARS = numpy.array([count_nonzero_vars(X[:,i]) for i in range(len(scan_vals))])
+            
+            best = print_sweep_table(args.algorithm, scan_vals, Y, b, NVARS)
+            
+            for out_file in ("x.txt", "Ax.txt", "dlars.log"):
+                shutil.copy(os.path.join(DIRS[best], out_file), out_file)
+                
+            args.alpha = scan_vals[best]
+            print ('! DLARS alpha = %10.4e (from %s)' % (args.alpha, DIRS[best]))
+            
+            x = X[:,best]
+            y = Y[:,best]
+            
+        else:
+            x,y = fit_dlars(dlasso_dlars_path, args.nodes, args.cores, args.alpha, args.split_files, args.algorithm, args.read_output, args.weights, args.normalize, args.A , args.b ,args.restart_dlasso_dlars, args.mpistyle, args.dlars_walltime, args.dlars_progress, 
+                            args.dlars_checkpoint, args.dlars_resume)
+            
         np = count_nonzero_vars(x)
         nvars = np
         
@@ -274,470 +835,3141 @@ def main():
         print ("Unrecognized fitting algorithm") 
         exit(1)
 
+    # Rank 0 holds the gathered predictions and writes force.txt and the parameter file
+    
+    if MPI_COMM is not None and MPI_COMM.Get_rank() != 0:
+        return 0
+
     #################################
     # Process output from solver(s)
     #################################
 
     # If split_files, A is not read in ...This conditional should really be set by the algorithm, since many set  y themselves...  
       
-    if ( (not args.split_files) and (not args.read_output) and (not args.active ) and (args.algorithm != "dlasso") ):
-        y=dot(A,x)
+    if A_IN_MEMORY:
+        y=A.dot(x)
         
-    Z=0.0
-
-    # Put calculated forces in force.txt
+        if ZERO_WEIGHT is not None:
+            y = unweight_predictions(y, x, WEIGHTS, ZERO_WEIGHT)
+        
+    LAYOUT = load_header_layout(args.header, cache=args.binary_cache)
+    
+    with open(args.map, "r") as mapf:
+        MAP_LINES = mapf.readlines()
+        
+    if NTARGETS > 1:
+        HEADER     = sys.stdout.getvalue()
+        sys.stdout = STDOUT
+        
+        sys.stdout.write(HEADER)
+        print ("! Targets fit with one factorization:")
+        print ("!   %-24s %-15s %s" % ("b file", "RMS force error", "Parameter file"))
+        
+        (X, Y, B) = (x, y, b)
+        
+    # Output files are force<suffix>.txt etc.: with several targets, suffix is .<target name>
+    # and the parameter file goes to params<suffix>.txt instead of stdout.
     
-    yfile = open("force.txt", "w")
+    for target in range(NTARGETS):
     
-    for a in range(0,len(b)):
-        Z = Z + (y[a] - b[a]) ** 2.0
-        yfile.write("%13.6e\n"% y[a]) 
-
-    bic = float(nlines) * log(Z/float(nlines)) + float(nvars) * log(float(nlines))
+        suffix = ""
+        
+        if NTARGETS > 1:
+            suffix     = "." + TARGET_NAMES[target]
+            (x, y, b)  = (X[:,target], Y[:,target], B[:,target])
+            sys.stdout = open("params" + suffix + ".txt", "w")
+            
+            sys.stdout.write(HEADER)
+            print ("! Target                         =  " + TARGET_NAMES[target])
+            
+        Z=0.0
 
-    #############################################
-    # Setup output
-    #############################################
+        if args.append:
     
-    print ("! RMS force error                = %11.4e" % sqrt(Z/float(nlines)))
-    print ("! max abs variable               = %11.4e" %  max(abs(x)))
-    print ("! number of fitting vars         = ", nvars)
-    print ("! Bayesian Information Criterion = %11.4e" % bic)
-    if args.weights !="None":
-        print ('! Using weighting file:            ',args.weights)
-    print ("!")
-
-    ####################################
-    # Actually process the header file...
-    ####################################
+            # Predictions for all rows would require reading all of A again: the residual comes
+            # from the unweighted normal equations kept in the fit state instead.
+        
+            print ("! force.txt not written for incremental refits")
+        
+            Z = fit_state_residual(STATE, x)
+        
+        else:
 
-    hf = open(args.header ,"r").readlines()
-    
-    BREAK_COND = False
+            # Put calculated forces in force.txt
     
-    EXCL_2B = []
+            Z = numpy.sum((y - b) ** 2.0)
+        
+            with open("force" + suffix + ".txt", "w") as yfile:
+                numpy.savetxt(yfile, y, fmt="%13.6e")
+            
+            if args.force_npy:
+                numpy.save("force" + suffix + ".npy", y)
 
-    # Figure out whether we have triplets and/or quadruplets
-    # Find the ATOM_TRIPS_LINE and ATOM_QUADS_LINE
-    # Find the TOTAL_TRIPS and TOTAL_QUADS
+        bic = float(nlines) * log(Z/float(nlines)) + float(nvars) * log(float(nlines))
 
-    ATOM_TRIPS_LINE = 0
-    ATOM_QUADS_LINE = 0
-    TOTAL_TRIPS = 0
-    TOTAL_QUADS = 0
-
-    for i in range(0, len(hf)):
-        print (hf[i].rstrip('\n'))
-        TEMP = hf[i].split()
+        #############################################
+        # Setup output
+        #############################################
+    
+        print ("! RMS force error                = %11.4e" % sqrt(Z/float(nlines)))
+        print ("! max abs variable               = %11.4e" %  max(abs(x)))
+        print ("! number of fitting vars         = ", nvars)
+        print ("! Bayesian Information Criterion = %11.4e" % bic)
+        if args.weights !="None":
+            print ('! Using weighting file:            ',args.weights)
         
-        if "EXCL_2B" in hf[i]:
-            line = line.split()
-            EXCL_2B = line[1:]
+        if args.residuals and not args.append:
+            LABELS = read_labels(args.labels)
+            GROUPS, GROUP_NAMES = residual_groups(LABELS, read_atom_types(args.header, args.binary_cache), nlines)
+            if os.path.exists(args.traj_list) and os.path.exists(args.natoms):
+                GROUPS, GROUP_NAMES = add_traj_file_groups(GROUPS, GROUP_NAMES, load_matrix(args.natoms, cache=False), LABELS, 
+                                                           read_traj_list(args.traj_list))
+            print_residual_table(GROUP_NAMES, *residual_table(y - b, GROUPS, len(GROUP_NAMES)))
+        
+        if args.frame_errors != "" and not args.append:
+            write_frame_errors(args.frame_errors, y - b, load_matrix(args.natoms, cache=False), read_labels(args.labels), 
+                               read_atom_types(args.header, args.binary_cache), read_traj_list(args.traj_list))
+            print ("! Per-frame errors written to:    ", args.frame_errors)
+        
+        print ("!")
 
-        if len(TEMP)>3:
-            if (TEMP[2] == "TRIPLETS:"):
-                TOTAL_TRIPS = TEMP[3]
-                ATOM_TRIPS_LINE = i
+        ####################################
+        # Actually process the header file...
+        ####################################
 
-                for j in range(i, len(hf)):
-                    TEMP = hf[j].split()
-                    if len(TEMP)>3:
-                        if (TEMP[2] == "QUADRUPLETS:"):
-                            print (hf[j].rstrip('\n'))
-                            TOTAL_QUADS = TEMP[3]
-                            ATOM_QUADS_LINE = j
-                            BREAK_COND = True
-                            break
-            if (BREAK_COND):
-                 break
+        # The parameter file is formatted from the header layout and written in one operation
 
-    # 1. Figure out what potential type we have
+        if args.prune != "":
+        
+            REDUCED, XR, NZEROED, NKEPT, NREMOVED = prune_layout(LAYOUT, x, args.prune_tol)
+        
+            with open(args.prune, "w") as prunef:
+                prunef.write(format_params(REDUCED, XR, MAP_LINES))
+            
+            print ("! Pruned parameter file written to: ", args.prune)
+            print ("! Pair coefficients zeroed       = ", NZEROED)
+            print ("! Cluster coefficient lines kept = ", NKEPT)
+            print ("! Cluster coefficient lines cut  = ", NREMOVED)
+            print ("!")
+        
+        sys.stdout.write(format_params(LAYOUT, x, MAP_LINES))
 
-    POTENTIAL = hf[5].split()
-    POTENTIAL = POTENTIAL[1]
+        if args.test_suite:
+            with open("test_suite_params" + suffix + ".txt", "w") as test_suite_params:
+                test_suite_params.write("".join(["%5d %21.13e\n" % (i, x[i]) for i in range(0, len(x))]))
 
-    print ("")
 
-    print ("PAIR " + POTENTIAL + " PARAMS \n")
+        if NTARGETS > 1:
+            sys.stdout.close()
+            sys.stdout = STDOUT
+            
+            print ("!   %-24s %11.4e     %s" % (TARGET_NAMES[target], sqrt(Z/float(nlines)), "params" + suffix + ".txt"))
+            
+    return 0
 
-    # 2. Figure out how many coeffs each atom type will have
+#############################################
+#############################################
+# Small helper functions
+#############################################
+#############################################
 
-    SNUM_2B = 0
-    SNUM_4B = 0
+def is_number(s):
+# Test if s is a number.
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
 
-    if POTENTIAL == "CHEBYSHEV":
-        
-        TMP = hf[5].split()
 
-        if len(TMP) >= 4:
-            if len(TMP) >= 5:
-                SNUM_4B = int(TMP[4])
+def str2bool(v):
+## Convert string to bool.  Used in command argument parsing.
+    if v.lower() in ('yes', 'true', 't', 'y'):
+        return True
+    elif v.lower() in ('no', 'false', 'f', 'n'):
+        return False
+    else:
+        raise argparse.ArgumentTypeError("Boolean value expected")
+                       
 
-            SNUM_2B = int(TMP[2])  
- 
+def count_nonzero_vars(x):
+    np = 0
+    for i in range(0, len(x)):
+        if ( abs(x[i]) > 1.0e-05 ):
+            np = np + 1
+    return np
 
-    # 3. Print out the parameters
 
-    FIT_COUL = hf[1].split()
-    FIT_COUL = FIT_COUL[1]
+def target_names(b_files, ncols):
+## Names of the fit targets (the columns of b) for output file suffixes: the b file name 
+## without its extension, followed by .<column> for multi-column files.  Where names 
+## coincide, the target number is used instead.
 
-    ATOM_TYPES_LINE  = 7
-    TOTAL_ATOM_TYPES = hf[ATOM_TYPES_LINE].split()
-    TOTAL_ATOM_TYPES = int(TOTAL_ATOM_TYPES[2])
-    ATOM_PAIRS_LINE  = ATOM_TYPES_LINE+2+TOTAL_ATOM_TYPES+2
-    TOTAL_PAIRS      = hf[ATOM_PAIRS_LINE].split()
-    TOTAL_PAIRS      = int(TOTAL_PAIRS[2])
+    names = []
     
-    # Remove excluded 2b interactions from accounting
-    
-    TOTAL_PAIRS -= len(EXCL_2B) 
-
-    A1 = ""
-    A2 = ""
+    for (b_file, n) in zip(b_files, ncols):
+        stem   = os.path.splitext(os.path.basename(b_file))[0]
+        names += [stem] if n == 1 else [stem + "." + str(col) for col in range(n)]
+        
+    if len(set(names)) < len(names):
+        names = [str(i) for i in range(len(names))]
+        
+    return names
 
-    P1 = ""
-    P2 = ""
-    P3 = ""
 
-    # PAIRS, AND CHARGES
+def count_workers():
+## Number of cores available to this process (respects CPU affinity set by the batch system).
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
 
-    # Figure out how many 3B parameters there are
 
-    SNUM_3B   = 0
-    ADD_LINES = 0
-    COUNTED_COUL_PARAMS = 0 
+# Read-only data shared with ordered_map workers (see below).
 
-    if (int(TOTAL_TRIPS) > 0):
-        for t in range(0, int(TOTAL_TRIPS)):
+SHARED = None
 
-            P1 = hf[ATOM_TRIPS_LINE+3+ADD_LINES].split()
 
-            if P1[4] != "EXCLUDED:":
-                SNUM_3B +=  int(P1[4])
+class MatrixFileError(Exception):
+## A malformed or truncated A, b or weight file.  Raised rather than exiting, since the 
+## file may be read by an ordered_map worker; reported (and exits) in the main process.
+    pass
+    
 
-                TOTL = P1[6]
-                ADD_LINES += 5
+class WorkerExit(Exception):
+## exit() called in an ordered_map worker, e.g. after a failed factorization.  The error
+## message has already been written to stderr.
+    pass
+    
 
-                for i in range(0, int(TOTL)):
-                    ADD_LINES += 1
+def pool_task(item):
+## Run func(task) in a pool worker.  A worker that exits loses its task, and the pool would 
+## wait for it forever, so exit() is passed on to the main process as WorkerExit.
 
-    # Figure out how many 4B parameters there are
+    (func, task) = item
+    
+    try:
+        return func(task)
+    except SystemExit:
+        raise WorkerExit()
+        
 
-    SNUM_4B   = 0
-    ADD_LINES = 0
+def ordered_map(func, tasks, workers, shared=None):
+## Apply func to each task in a pool of worker processes, yielding the results in task order
+## so that reductions over them are deterministic.  Runs serially when workers <= 1.
+##
+## shared is published as the module global SHARED before the pool starts.  Workers are 
+## forked where the platform allows it, so large read-only arrays in shared (e.g. A) are 
+## seen by every worker without being pickled or copied.
+##
+## An exception in a worker is raised again here, after the remaining workers are stopped.
+
+    global SHARED
+    SHARED = shared
+
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield func(task)
+        return
+        
+    if "fork" in multiprocessing.get_all_start_methods():
+        pool = multiprocessing.get_context("fork").Pool(processes=numpy.minimum(workers, len(tasks)))
+    else:
+        pool = multiprocessing.Pool(processes=numpy.minimum(workers, len(tasks)))
+    
+    try:
+        for result in pool.imap(pool_task, [(func, task) for task in tasks]):
+            yield result
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.close()
+        pool.join()
 
-    if (int(TOTAL_QUADS) > 0):
-        for t in range(0, int(TOTAL_QUADS)):
 
-            P1 = hf[ATOM_QUADS_LINE+3+ADD_LINES].split()
+#############################################
+#############################################
+# Frame bookkeeping
+#############################################
+#############################################
 
-            #print "QUAD HEADER", P1
-            if P1[7] != "EXCLUDED:":
+# Row kinds in A/b, following A_Matrix::PRINT_FRAME: each frame holds 3N force rows, then 
+# optionally 3 or 9 stress rows and 3 energy rows.  Charge constraint rows follow the last 
+# frame and have no natoms.txt entry.
 
-                SNUM_4B +=  int(P1[7])
+ROW_FORCE  = 0
+ROW_STRESS = 1
+ROW_ENERGY = 2
 
-                TOTL = P1[9]
 
-                ADD_LINES += 5
+def read_labels(labeled_file):
+## First column of b-labeled.txt: <force flag><atom type>, <stress flag>s_xx ... or 
+## <energy flag>+1, one entry per row of b (charge constraint rows are not labeled).
 
-                for i in range(0,int(TOTL)):
-                    ADD_LINES += 1
+    with open(labeled_file, "r") as labf:
+        return numpy.array([line.split(None, 1)[0] for line in labf if line.strip() != ""])
 
-    for i in range(0,TOTAL_PAIRS):
 
-        A1 = hf[ATOM_PAIRS_LINE+2+i+1].split()
-        A2 = A1[2]
-        A1 = A1[1]
+def label_kind(label):
+## ROW_FORCE, ROW_STRESS or ROW_ENERGY for one b-labeled.txt label.
 
-        #print ("PAIRTYPE PARAMS: " + `i` + " " + A1 + " " + A2 + "\n")
-        print ("PAIRTYPE PARAMS: " + str(i) + " " + A1 + " " + A2 + "\n")
+    if label.endswith("+1"):
+        return ROW_ENERGY
+    elif label[-4:-2] == "s_" and label[-2] in "xyz" and label[-1] in "xyz":
+        return ROW_STRESS
+    
+    return ROW_FORCE
+    
 
-        for j in range(0, int(SNUM_2B)):
-            print ("%3d %21.13e" % (j,x[i*SNUM_2B+j]))
+def row_kinds(labels):
+## Classify b-labeled.txt labels as ROW_FORCE, ROW_STRESS or ROW_ENERGY.  Each distinct 
+## label is classified once.
 
-        if FIT_COUL == "true":
-            print ("q_%s x q_%s %21.13e" % (A1,A2,x[TOTAL_PAIRS*SNUM_2B + SNUM_3B + SNUM_4B + i]))
-            COUNTED_COUL_PARAMS += 1
+    unique, inverse = numpy.unique(labels, return_inverse=True)
+    
+    return numpy.array([label_kind(label) for label in unique], dtype=numpy.int8)[inverse]
 
-        print (" ")
 
-    # TRIPLETS
+def frame_index(natoms, kinds, nlines):
+## Map each of the nlines rows of A to its frame number: 3N force rows followed by any 
+## stress and energy rows, with N taken from natoms.txt.  Rows without a natoms.txt entry 
+## (charge constraints) get frame -1.
 
-    ADD_LINES = 0
-    ADD_PARAM = 0
+    natoms = numpy.asarray(natoms, dtype=int)
+    frames = numpy.full(nlines, -1, dtype=int)
+    nrows  = len(natoms)
+    row    = 0
+    frame  = 0
+    
+    if len(kinds) < nrows:
+        sys.stderr.write("Error: fewer labeled rows than natoms.txt entries\n")
+        exit(1)
+    
+    while row < nrows:
+        end = row + 3 * natoms[row]
+        
+        if end > nrows or numpy.any(kinds[row:end] != ROW_FORCE):
+            sys.stderr.write("Error: row " + str(row) + " does not start a frame of " + str(natoms[row]) + " atoms\n")
+            exit(1)
+            
+        while end < nrows and kinds[end] != ROW_FORCE:
+            end += 1
+            
+        frames[row:end] = frame
+        frame += 1
+        row    = end
+        
+    return frames
 
-    COUNTED_TRIP_PARAMS = 0
 
-    if (int(TOTAL_TRIPS) > 0):
-        print ("TRIPLET " + POTENTIAL + " PARAMS \n")
+#############################################
+#############################################
+# Residual analytics
+#############################################
+#############################################
 
-        TRIP_PAR_IDX = 0
+def read_atom_types(header_file, cache=False):
+## Atom type names from the ATOM TYPES block of params.header.
 
-        for t in range(0, int(TOTAL_TRIPS)):
+    return list(load_header_layout(header_file, cache)["atom_types"])
 
-            PREV_TRIPIDX = 0
 
-            print ("TRIPLETTYPE PARAMS:")
-            print ("  " + hf[ATOM_TRIPS_LINE+2+ADD_LINES].rstrip())
+def split_label(label, atom_types):
+## Split a b-labeled.txt label into (kind, trajectory flag, name), where name is the atom 
+## type of a force row, the component (s_xx ...) of a stress row, or "+1" for an energy row.
+## The flag is the INFILE_*_FLAGS prefix set for the trajectory file in fm_setup.in.
 
-            P1 = hf[ATOM_TRIPS_LINE+3+ADD_LINES].split()
+    kind = label_kind(label)
+    
+    if kind == ROW_ENERGY:
+        return kind, label[:-2], "+1"
+    elif kind == ROW_STRESS:
+        return kind, label[:-4], label[-4:]
+        
+    # Force rows: the longest atom type matching the end of the label
+    
+    for atom_type in sorted(atom_types, key=len, reverse=True):
+        if label.endswith(atom_type):
+            return kind, label[:-len(atom_type)], atom_type
+            
+    return kind, "", label
+    
+    
+def residual_groups(labels, atom_types, nlines):
+## Residual groups of the nlines rows of b.  Returns a (2, nlines) array of group numbers 
+## and the group names: the first row assigns every row to the force rows of its atom type, 
+## a stress component, the energy rows, or (for rows beyond the labels, i.e. charge 
+## constraints) the constraint rows; the second row assigns labeled rows to their 
+## trajectory flag, or -1 when no flag was set.  Each distinct label is parsed once.
+
+    unique, inverse = numpy.unique(labels, return_inverse=True)
+    
+    names      = []
+    kind_group = numpy.zeros(len(unique), dtype=int)
+    flag_group = numpy.full(len(unique), -1, dtype=int)
+    kind_names = {ROW_FORCE : "force ", ROW_STRESS : "stress ", ROW_ENERGY : "energy"}
+    
+    for i in range(len(unique)):
+    
+        (kind, flag, name) = split_label(unique[i], atom_types)
+        
+        group = kind_names[kind] + (name if kind != ROW_ENERGY else "")
+        
+        if group not in names:
+            names.append(group)
+        kind_group[i] = names.index(group)
+        
+        if flag != "":
+            if "flag " + flag not in names:
+                names.append("flag " + flag)
+            flag_group[i] = names.index("flag " + flag)
+            
+    # Order the groups as forces, stresses, energies, flags
+    
+    order  = sorted(range(len(names)), key=lambda g: (["force", "stress", "energy", "flag"].index(names[g].split()[0]), names[g]))
+    rename = numpy.argsort(order)
+    names  = [names[g] for g in order]
+    
+    groups = numpy.full((2, nlines), -1, dtype=int)
+    
+    groups[0, :len(labels)] = rename[kind_group][inverse]
+    groups[1, :len(labels)] = numpy.where(flag_group >= 0, rename[flag_group], -1)[inverse]
+    
+    if nlines > len(labels):
+        names.append("constraints")
+        groups[0, len(labels):] = len(names) - 1
+    
+    return groups, names
 
-            #print "HEADER: ", P1
 
-            V0 = P1[1] 
-            V1 = P1[2]
-            V2 = P1[3]
+def residual_table(err, groups, ngroups):
+## Rows, RMS error and max absolute error of err for each group number in groups (any 
+## array shape; rows in group -1 are ignored).
 
-            if P1[4] == "EXCLUDED:" :
-                print ("   PAIRS: " + V0 + " " + V1 + " " + V2 + " EXCLUDED:")
-                ADD_LINES += 1
-            else:
-                UNIQ = P1[4]
-                TOTL = P1[6].rstrip() 
+    err    = numpy.broadcast_to(err, groups.shape).ravel()
+    groups = groups.ravel()
+    use    = groups >= 0
+    
+    counts = numpy.bincount(groups[use], minlength=ngroups)
+    sumsq  = numpy.bincount(groups[use], weights=err[use] ** 2, minlength=ngroups)
+    maxerr = numpy.zeros(ngroups)
+    
+    numpy.maximum.at(maxerr, groups[use], numpy.abs(err[use]))
+    
+    rms = sqrt(sumsq / numpy.maximum(counts, 1))
+    
+    return counts, rms, maxerr
 
-                print ("   PAIRS: " + V0 + " " + V1 + " " + V2 + " UNIQUE: " + UNIQ + " TOTAL: " + TOTL)
-                print ("     index  |  powers  |  equiv index  |  param index  |       parameter       ")
-                print ("   ----------------------------------------------------------------------------")
 
-                ADD_LINES += 3
+def print_residual_table(names, counts, rms, maxerr):
 
-                if(t>0):
-                    ADD_PARAM += 1
+    print ("! Residuals by label")
+    print ("! %-24s %10s %15s %15s" % ("group", "rows", "RMS error", "max abs error"))
+    
+    for i in range(len(names)):
+        print ("! %-24s %10d %15.4e %15.4e" % (names[i], counts[i], rms[i], maxerr[i]))
 
-                for i in range(0,int(TOTL)):
-                    ADD_LINES += 1
-                    LINE       = hf[ATOM_TRIPS_LINE+2+ADD_LINES].rstrip('\n')
-                    LINE_SPLIT = LINE.split()
 
-                    print ("%s %21.13e" % (LINE, x[TOTAL_PAIRS*SNUM_2B + TRIP_PAR_IDX+int(LINE_SPLIT[5])]))
+def read_traj_list(traj_list):
+## (frames, file name) for each trajectory file of a MULTI traj_list.dat, in the order the 
+## files were read by chimes_lsq.  Empty if the file does not exist.
 
-                TRIP_PAR_IDX += int(UNIQ)
-                COUNTED_TRIP_PARAMS += int(UNIQ)
-                #print "COUNTED_TRIP_PARAMS", COUNTED_TRIP_PARAMS
+    if not os.path.exists(traj_list):
+        return []
+        
+    with open(traj_list, "r") as trajf:
+        nfiles = int(next(trajf).split()[0])
+        files  = []
+        
+        for i in range(nfiles):
+            line = next(trajf).split()
+            files.append((int(line[0]), line[1]))
+            
+    return files
 
-            print ("")
 
-            ADD_LINES += 2
+def frame_traj_files(traj_files, nframes):
+## Index into traj_files (see read_traj_list) of the trajectory file each of nframes frames 
+## was read from, or None unless the frame counts of traj_files cover all frames.
 
-    ADD_LINES = 0
+    if len(traj_files) == 0 or numpy.sum([nf for (nf, name) in traj_files]) != nframes:
+        return None
+        
+    ends = numpy.cumsum([nf for (nf, name) in traj_files])
     
-    # QUADS    
+    return numpy.searchsorted(ends, numpy.arange(nframes), side='right')
 
-    COUNTED_QUAD_PARAMS = 0
-    if (int(TOTAL_QUADS) > 0):
-        print ("QUADRUPLET " + POTENTIAL + " PARAMS \n")
 
-        QUAD_PAR_IDX = 0
+def add_traj_file_groups(groups, names, natoms, labels, traj_files):
+## Add a row of residual groups to groups (see residual_groups) that assigns the rows of 
+## each frame to the trajectory file it was read from.  groups and names are returned 
+## unchanged unless traj_files covers all frames.
 
-        for t in range(int(TOTAL_QUADS)):
+    frames = frame_index(natoms, row_kinds(labels), groups.shape[1])
+    files  = frame_traj_files(traj_files, frames.max() + 1)
+    
+    if files is None:
+        return groups, names
+        
+    (file_names, file_group) = numpy.unique([name for (nf, name) in traj_files], return_inverse=True)
+    
+    row = numpy.full(groups.shape[1], -1, dtype=int)
+    
+    row[frames >= 0] = len(names) + file_group[files[frames[frames >= 0]]]
+    
+    return numpy.vstack((groups, row)), names + ["file " + name for name in file_names]
 
-            PREV_QUADIDX = 0
 
-            #print "ATOM_QUADS_LINE " + str(ATOM_QUADS_LINE+2+ADD_LINES)
+def write_frame_errors(out_file, err, natoms, labels, atom_types, traj_files):
+## Rank the frames by force RMS error and write a table of frame number, source file, 
+## natoms and force, stress and energy RMS errors (nan if the frame has no such rows), 
+## worst first.  The source file comes from traj_files (see read_traj_list) when its frame 
+## counts cover all frames, and is otherwise the force flag of the frame's labels ("-" if 
+## none was set).
 
-            P1 = hf[ATOM_QUADS_LINE+2+ADD_LINES].split()
+    kinds  = row_kinds(labels)
+    frames = frame_index(natoms, kinds, len(err))
+    
+    nframes = frames.max() + 1
+    use     = numpy.flatnonzero(frames[:len(kinds)] >= 0)
+    rms     = numpy.full((nframes, 3), nan)
+    
+    for kind in (ROW_FORCE, ROW_STRESS, ROW_ENERGY):
+    
+        rows   = use[kinds[use] == kind]
+        counts = numpy.bincount(frames[rows], minlength=nframes)
+        sumsq  = numpy.bincount(frames[rows], weights=err[rows] ** 2, minlength=nframes)
+        
+        rms[counts > 0, kind] = sqrt(sumsq[counts > 0] / counts[counts > 0])
+        
+    first = numpy.unique(frames[use], return_index=True)[1]     # First row of each frame
+    
+    files = frame_traj_files(traj_files, nframes)
+    
+    if files is not None:
+        sources = numpy.array([name for (nf, name) in traj_files])[files]
+    else:
+        sources = numpy.array([split_label(label, atom_types)[1] for label in labels[first]])
+        sources[sources == ""] = "-"
+        
+    order = numpy.argsort(-numpy.nan_to_num(rms[:,ROW_FORCE], nan=-1.0), kind='stable')
+    
+    with open(out_file, "w") as outf:
+        outf.write("# %6s %8s %-40s %8s %15s %15s %15s\n" % ("rank", "frame", "source", "natoms", "force_rms", "stress_rms", "energy_rms"))
+        outf.write("".join(["  %6d %8d %-40s %8d %15.6e %15.6e %15.6e\n" % (rank, f, sources[f], natoms[first[f]], rms[f,0], rms[f,1], rms[f,2]) 
+                            for (rank, f) in enumerate(order, 1)]))
 
-            #print "P1 " + P1[1] + P1[2] + P1[3] + P1[4] + P1[5] + P1[6]
 
-            print ("QUADRUPLETYPE PARAMS: " )
-            print ("  " + hf[ATOM_QUADS_LINE+2+ADD_LINES].rstrip() )
+#############################################
+#############################################
+# In-memory solvers used by the cross validation and ensemble drivers
+#############################################
+#############################################
 
-            P1 = hf[ATOM_QUADS_LINE+3+ADD_LINES].split()
+def fit_in_memory(A, b, algorithm, eps, alpha, svd_driver="gesdd"):
+## Solve the (already weighted) system A x = b with one of the in-memory algorithms and 
+## return x.  A may be overwritten.
 
-            #print P1 
+    if algorithm == 'svd':
+        D, VT, Utb = svd_factor(A, b, svd_driver, overwrite_a=True)
+        return svd_truncated_solution(D, VT, Utb, eps)[0]
+        
+    if algorithm in ('ridge', 'cholesky'):
+        return solve_normal_equations(dot(transpose(A), A), dot(transpose(A), b), algorithm, eps, alpha)[0]
+        
+    from sklearn import linear_model
+    
+    if algorithm == 'lasso':
+        reg = linear_model.Lasso(alpha=alpha, fit_intercept=False, max_iter=100000)
+        reg.fit(A, b)
+        return reg.coef_
+        
+    if algorithm == 'lassolars':
+        reg = linear_model.LassoLars(alpha=alpha, fit_intercept=False, fit_path=False, max_iter=100000, copy_X=False)
+        reg.fit(A, b)
+        return reg.coef_[0]
+        
+    print ("Unrecognized fitting algorithm " + algorithm) 
+    exit(1)
 
-            V0 = P1[1] 
-            V1 = P1[2]
-            V2 = P1[3]
-            V3 = P1[4] 
-            V4 = P1[5]
-            V5 = P1[6]
 
-            #print "UNIQUE: ", str(UNIQ)
-            if P1[7] == "EXCLUDED:" :
-                print ("   PAIRS: " + V0 + " " + V1 + " " + V2 + " " + V3 + " " + V4 + " " + V5 + " EXCLUDED: ")
-                ADD_LINES += 1
+def fit_iterative(A, b, algorithm, alpha, iter_limit=0, tol=1.0e-10, x0=None):
+## LSQR, LSMR or conjugate gradient (cg) solution of min ||A x - b||^2 + alpha ||x||^2 (the 
+## ridge objective) for a dense or sparse A, optionally starting from x0.  The columns of A 
+## are scaled to unit norm, which the damping of the scipy least-squares solvers cannot 
+## follow, so alpha enters as sqrt(alpha) * diag(scale) rows appended to the scaled A; cg
+## solves the equally scaled normal equations.  Returns x, the stopping reason (the info 
+## flag for cg) and the number of iterations.  iter_limit = 0 allows 10 * n iterations.
 
-            else:
-                UNIQ = P1[7]
-                TOTL = P1[9].rstrip() 
+    import scipy.sparse.linalg
+    
+    norms = numpy.sqrt(numpy.asarray(A.power(2).sum(axis=0) if scipy.sparse.issparse(A) else (A ** 2).sum(axis=0)).ravel())
+    scale = numpy.zeros(len(norms))
+    
+    scale[norms > 0.0] = 1.0 / norms[norms > 0.0]
+    
+    (m, n) = A.shape
+    damp   = sqrt(alpha)
+    
+    def matvec(z):
+        return numpy.concatenate((A.dot(scale * z), damp * scale * z))
+        
+    def rmatvec(r):
+        return scale * (A.T.dot(r[:m]) + damp * r[m:])
+        
+    op  = scipy.sparse.linalg.LinearOperator((m + n, n), matvec=matvec, rmatvec=rmatvec, dtype=float)
+    rhs = numpy.concatenate((b, numpy.zeros(n)))
+    z0  = None
+    
+    if x0 is not None:
+        z0              = numpy.zeros(n)
+        z0[scale > 0.0] = x0[scale > 0.0] / scale[scale > 0.0]
+        
+    limit = iter_limit if iter_limit > 0 else 10 * n
+    
+    if algorithm == 'cg':
+    
+        # S (A^T A + alpha I) S z = S A^T b, with x = S z
+        
+        iters  = [0]
+        normal = scipy.sparse.linalg.LinearOperator((n, n), dtype=float, 
+                                                    matvec=lambda z: scale * A.T.dot(A.dot(scale * z)) + alpha * scale * scale * z)
+                                                    
+        def count(zk):
+            iters[0] += 1
+            
+        (z, info) = scipy.sparse.linalg.cg(normal, scale * A.T.dot(b), x0=z0, rtol=tol, maxiter=limit, callback=count)
+        
+        return scale * z, int(info), iters[0]
+        
+    if algorithm == 'lsqr':
+        out = scipy.sparse.linalg.lsqr(op, rhs, atol=tol, btol=tol, iter_lim=limit, x0=z0)
+    else:
+        out = scipy.sparse.linalg.lsmr(op, rhs, atol=tol, btol=tol, maxiter=limit, x0=z0)
+        
+    return scale * out[0], int(out[1]), int(out[2])
 
-                print ("   PAIRS: " + V0 + " " + V1 + " " + V2 + " " + V3 + " " + V4 + " " + V5 + " UNIQUE: " + UNIQ + " TOTAL: " + TOTL)
-                print ("     index  |  powers  |  equiv index  |  param index  |       parameter       ")
-                print ("   ----------------------------------------------------------------------------")
 
-                ADD_LINES += 3
+def check_iterative_stop(algorithm, istop, itn, iter_limit):
+## Report an lsqr, lsmr or cg solve that reached its iteration limit (istop 7, or a positive
+## cg info flag) before --iter_tol.  The run is stopped unless the limit was set explicitly
+## with --iter_limit, in which case the (inaccurate) solution is kept with a warning.
 
-                if(t>0):
-                    ADD_PARAM += 1
+    if (algorithm == 'cg' and istop > 0) or (algorithm != 'cg' and istop == 7):
+    
+        msg = "the " + algorithm + " solver did not converge to --iter_tol in " + str(itn) + " iterations"
+        
+        if iter_limit > 0:
+            sys.stderr.write("Warning: " + msg + " (--iter_limit); the parameters may be inaccurate\n")
+        else:
+            sys.stderr.write("Error: " + msg + "; set a larger --iter_limit\n")
+            exit(1)
 
-                for i in range(0,int(TOTL)):
-                    ADD_LINES += 1
-                    LINE       = hf[ATOM_QUADS_LINE+2+ADD_LINES].rstrip('\n')
-                    LINE_SPLIT = LINE.split()
 
-                    UNIQ_QUAD_IDX = int(LINE_SPLIT[8])
-                    #print 'UNIQ_QUAD_IDX', str(UNIQ_QUAD_IDX)
+def cv_fold_worker(task):
+## Fit one cross validation fold on the shared, unweighted A and return the test RMS force error.
 
-                    print ("%s %21.13e" % (LINE,x[TOTAL_PAIRS*SNUM_2B + COUNTED_TRIP_PARAMS + QUAD_PAR_IDX + UNIQ_QUAD_IDX]))
+    (test_rows, algorithm, eps, alpha, svd_driver) = task
+    (A, b, weights) = SHARED
+    
+    train = numpy.ones(A.shape[0], dtype=bool)
+    train[test_rows] = False
+    
+    A_train = A[train]      # Private copy; weighted in place below
+    b_train = b[train]
+    
+    if weights is not None:
+        apply_row_weights(A_train, weights[train])
+        b_train = b_train * weights[train]
+        
+    x = fit_in_memory(A_train, b_train, algorithm, eps, alpha, svd_driver)
+    
+    return sqrt(numpy.mean((dot(A[test_rows], x) - b[test_rows]) ** 2))
 
-                QUAD_PAR_IDX += int(UNIQ)
-                COUNTED_QUAD_PARAMS += int(UNIQ)
 
-            print ("")
+def frame_cross_validation(A, b, weights, frames, folds, algorithm, eps, alpha, svd_driver, workers):
+## K-fold cross validation with whole frames held out, so force components of a frame never
+## appear in both the training and the test set.  Frames are assigned to folds in a fixed 
+## random order; charge constraint rows (frame -1) are always trained on.  Folds run in 
+## parallel and share A with the workers.  Returns a list of (test frames, test rows, test RMS).
 
-            ADD_LINES += 2
+    nframes = frames.max() + 1
+    
+    if folds < 2 or folds > nframes:
+        print ("Number of CV folds must be between 2 and the number of frames (" + str(nframes) + ")")
+        exit(1)
+    
+    fold_of = numpy.empty(nframes, dtype=int)
+    fold_of[numpy.random.default_rng(0).permutation(nframes)] = numpy.arange(nframes) % folds
+    
+    row_fold = numpy.where(frames >= 0, fold_of[frames], -1)
+    tasks    = [(numpy.flatnonzero(row_fold == k), algorithm, eps, alpha, svd_driver) for k in range(folds)]
+    
+    rms = list(ordered_map(cv_fold_worker, tasks, workers, (A, b, weights)))
+    
+    return [(int(numpy.count_nonzero(fold_of == k)), len(tasks[k][0]), rms[k]) for k in range(folds)]
 
-    # Remaining tidbids
 
-    mapsfile=open(args.map,"r").readlines()
+def print_cv_table(algorithm, cv_rms):
+## Print per-fold and mean test RMS force errors as comment lines.
 
-    print ("")
+    print ("! Frame-grouped %d-fold cross validation (%s algorithm)" % (len(cv_rms), algorithm))
+    print ("! %6s %12s %12s %20s" % ("fold", "test frames", "test rows", "test RMS force err"))
+    
+    for k in range(len(cv_rms)):
+        print ("! %6d %12d %12d %20.4e" % (k + 1, cv_rms[k][0], cv_rms[k][1], cv_rms[k][2]))
+        
+    print ("! Mean test RMS force error      = %11.4e" % numpy.mean([item[2] for item in cv_rms]))
+    print ("!")
 
-    for i in range(0,len(mapsfile)):
-        print (mapsfile[i].rstrip('\n'))
 
-    print ("")
+def ensemble_member_worker(task):
+## Fit one bootstrap ensemble member on the shared, unweighted A and return its solution.
+## The rows of a frame drawn k times are scaled by sqrt(k), which gives the same least-squares
+## problem as k copies of them; only the rows of drawn frames are copied.
 
-    total_params = TOTAL_PAIRS * SNUM_2B + COUNTED_TRIP_PARAMS + COUNTED_QUAD_PARAMS + COUNTED_COUL_PARAMS 
+    (counts, algorithm, eps, alpha, svd_driver) = task
+    (A, b, weights, frames) = SHARED
+    
+    row_counts = numpy.where(frames >= 0, counts[frames], 1)    # Charge constraint rows are always kept
+    rows       = numpy.flatnonzero(row_counts > 0)
+    scale      = sqrt(row_counts[rows].astype(float))
+    
+    if weights is not None:
+        scale = scale * weights[rows]
+        
+    if algorithm in ('lasso', 'lassolars'):
+    
+        # sklearn divides the squared error by the number of rows passed, not the number drawn
+        
+        scale = scale * sqrt(len(rows) / float(row_counts.sum()))
+        
+    A_train = A[rows]      # Private copy; weighted in place below
+    
+    apply_row_weights(A_train, scale)
+    
+    return fit_in_memory(A_train, b[rows] * scale, algorithm, eps, alpha, svd_driver)
+    
 
-    N_ENER_OFFSETS = int(hf[7].split()[2])
+def bootstrap_ensemble(A, b, weights, frames, members, algorithm, eps, alpha, svd_driver, workers):
+## Bootstrap ensemble: each member is fit to as many frames as there are, drawn with 
+## replacement in a fixed random order.  Charge constraint rows (frame -1) are in every 
+## member.  Members run in parallel and share A with the workers.  Returns the member 
+## solutions as the columns of X.
 
-## Parameter count could be off by natom_types, if energies are included in the fit
-    if (total_params != len(x)) and (len(x) != (total_params+N_ENER_OFFSETS)) :
-        sys.stderr.write( "Error in counting parameters\n") 
-        sys.stderr.write("len(x) " + str(len(x)) + "\n") 
-        sys.stderr.write("TOTAL_PAIRS " + str(TOTAL_PAIRS) + "\n") 
-        sys.stderr.write("SNUM_2B " + str(SNUM_2B) + "\n") 
-        sys.stderr.write("COUNTED_TRIP_PARAMS " + str(COUNTED_TRIP_PARAMS) + "\n") 
-        sys.stderr.write("COUNTED_QUAD_PARAMS " + str(COUNTED_QUAD_PARAMS) + "\n")
-        sys.stderr.write("COUNTED_COUL_PARAMS " + str(COUNTED_COUL_PARAMS) + "\n")
-        exit(1)
+    nframes = frames.max() + 1
+    rng     = numpy.random.default_rng(0)
+    tasks   = [(numpy.bincount(rng.integers(0, nframes, nframes), minlength=nframes), algorithm, eps, alpha, svd_driver) for k in range(members)]
+    
+    return numpy.column_stack(list(ordered_map(ensemble_member_worker, tasks, workers, (A, b, weights, frames))))
+    
 
+def write_ensemble(out_dir, X, Y, layout, map_lines):
+## Write a parameter file per ensemble member (params.%04d.txt), the mean and standard 
+## deviation of each parameter (params_stats.txt), and the mean and variance of the 
+## predictions for each row of A (force_var.txt) to out_dir.
 
-    if len(x) == (total_params+N_ENER_OFFSETS):
-        print ("NO ENERGY OFFSETS: ", N_ENER_OFFSETS)
+    os.makedirs(out_dir, exist_ok=True)
     
-        for i in range(N_ENER_OFFSETS):
-            print ("ENERGY OFFSET %d %21.13e" % (i+1,x[total_params+i]))
+    for k in range(X.shape[1]):
+        with open(os.path.join(out_dir, "params.%04d.txt" % k), "w") as paramf:
+            paramf.write("! Bootstrap ensemble member %d of %d\n!\n" % (k + 1, X.shape[1]))
+            paramf.write(format_params(layout, X[:,k], map_lines))
+            
+    with open(os.path.join(out_dir, "params_stats.txt"), "w") as statf:
+        statf.write("".join(["%5d %21.13e %21.13e\n" % (i, mean, std) for (i, (mean, std)) in 
+                             enumerate(zip(numpy.mean(X, axis=1), numpy.std(X, axis=1, ddof=1)))]))
+                             
+    with open(os.path.join(out_dir, "force_var.txt"), "w") as varf:
+        varf.write("".join(["%13.6e %13.6e\n" % (mean, var) for (mean, var) in zip(numpy.mean(Y, axis=1), numpy.var(Y, axis=1, ddof=1))]))
+        
 
-    if args.test_suite:
-        test_suite_params=open("test_suite_params.txt","w")		
-        for i in range(0,len(x)):
-            phrase = "%5d %21.13e\n" % (i,x[i])
-            test_suite_params.write(phrase)
-        test_suite_params.close()
+def print_ensemble_summary(out_dir, algorithm, X, Y):
+## Print the spread of the ensemble parameters and predictions as comment lines.
+
+    xstd = numpy.std(X, axis=1, ddof=1)
+    ystd = numpy.std(Y, axis=1, ddof=1)
+    
+    print ("! Bootstrap ensemble of %d members (%s algorithm), written to %s" % (X.shape[1], algorithm, out_dir))
+    print ("! Mean parameter std             = %11.4e" % numpy.mean(xstd))
+    print ("! Max parameter std              = %11.4e" % xstd.max())
+    print ("! Mean prediction std            = %11.4e" % numpy.mean(ystd))
+    print ("! Max prediction std             = %11.4e (row %d)" % (ystd.max(), numpy.argmax(ystd)))
+    print ("!")
 
-    print ("ENDFILE")
-    return 0
 
 #############################################
 #############################################
-# Small helper functions
+# SVD helpers
 #############################################
 #############################################
 
-def is_number(s):
-# Test if s is a number.
+def svd_factor(A, b, driver="gesdd", overwrite_a=False):
+## Economy factorization of A for the svd solver.  Returns the singular values D, VT and U^T b;
+## neither the nlines x nlines U of a full SVD nor a dense pseudo-inverse is formed.
+##
+## gesdd, gesvd: thin SVD of A with the given LAPACK driver.  The nlines x k U is dropped 
+##               as soon as U^T b is formed.
+## qr:           A = QR with Q^T b applied by LAPACK without forming Q, then the SVD of the 
+##               small k x np R.  U = Q U_R is never formed.
+
     try:
-        float(s)
-        return True
-    except ValueError:
-        return False
+        if driver == "qr":
+            bTQ, R   = scipy.linalg.qr_multiply(A, transpose(b), mode='right', overwrite_a=overwrite_a)
+            Qtb      = transpose(bTQ)
+            UR, D, VT = scipy.linalg.svd(R, full_matrices=False, overwrite_a=True)
+            Utb      = dot(transpose(UR), Qtb)
+        elif driver in ("gesdd", "gesvd"):
+            U, D, VT = scipy.linalg.svd(A, full_matrices=False, overwrite_a=overwrite_a, lapack_driver=driver)
+            Utb      = dot(transpose(U), b)
+        else:
+            print ("Unrecognized SVD driver: " + driver + ". Recognized options are gesdd, gesvd and qr")
+            exit(1)
+    except numpy.linalg.LinAlgError:
+        sys.stderr.write("SVD algorithm failed")
+        exit(1)
+        
+    return D, VT, Utb
 
 
-def str2bool(v):
-## Convert string to bool.  Used in command argument parsing.
-    if v.lower() in ('yes', 'true', 't', 'y'):
-        return True
-    elif v.lower() in ('no', 'false', 'f', 'n'):
-        return False
-    else:
-        raise argparse.ArgumentTypeError("Boolean value expected")
-                       
+def svd_truncated_solution(D, VT, Utb, eps):
+## x = V diag(1/D) U^T b, keeping only singular values larger than eps * max(D).  
+## Returns x, the number of retained singular values and the absolute cutoff.  With 
+## several columns in U^T b, x holds one solution per column.
 
-def count_nonzero_vars(x):
-    np = 0
-    for i in range(0, len(x)):
-        if ( abs(x[i]) > 1.0e-05 ):
-            np = np + 1
-    return np
+    cutoff = eps * numpy.abs(D).max()
+    keep   = numpy.abs(D) > cutoff
+    
+    x = dot(transpose(VT[keep]), transpose(transpose(Utb[keep]) / D[keep]))
+    
+    return x, int(numpy.count_nonzero(keep)), cutoff
 
 
-#############################################
-#############################################
-# DLARS wrapper
-#############################################
-#############################################
+def parse_sweep(spec):
+## Parse a --sweep value: either a comma separated list ("1e-5,1e-4,1e-3") or a log-spaced 
+## range "start:stop:num" with both end points included.
 
-def fit_dlars(dlasso_dlars_path, nodes, cores, alpha, split_files, algorithm, read_output, weights, normalize, A , b, restart_dlasso_dlars, mpistyle):
+    if ":" in spec:
+        (start, stop, num) = spec.split(":")
+        return numpy.logspace(numpy.log10(float(start)), numpy.log10(float(stop)), int(num))
+        
+    return numpy.array([float(v) for v in spec.split(",")])
 
-    # Use the Distributed LARS/LASSO fitting algorithm.  Returns both the solution x and
-    # the estimated force vector A * x, which is read from Ax.txt.    
-    
-    if dlasso_dlars_path == '':
-        print ("ERROR: DLARS/DLASSO  path not provided.")
-        print ("Please run again with --dlasso_dlars_path </absolute/path/to/dlars/dlasso/src/>")
-        exit(0)
 
-    if algorithm == 'dlasso' :
-        print ('! DLARS code for LASSO used')
-    elif algorithm == 'dlars' :
-        print ('! DLARS code for LARS used')
-    else:
-        print ("Bad algorithm in fit_dlars:" + algorithm)
-        exit(1)
-    print ('! DLARS alpha = %10.4e' % alpha)
+def sweep_solutions(D, VT, Utb, algorithm, values):
+## Solutions for a list of svd eps or ridge alpha values from a single factorization.
+## Returns X (np x nvalues), the number of fitted variables and the svd cutoff for each value.
+##
+## svd:   x = V diag(1/D) U^T b over D > eps * max(D)
+## ridge: x = V diag(D / (D^2 + alpha)) U^T b, equivalent to (A^T A + alpha I) x = A^T b
 
-    if not read_output:
+    X       = numpy.zeros((VT.shape[1], len(values)))
+    nvars   = numpy.zeros(len(values), dtype=int)
+    cutoffs = numpy.zeros(len(values))
     
-        dlars_file = dlasso_dlars_path + "dlars"
-        
-        if os.path.exists(dlars_file):
-	
-            exepath = ""
+    for i in range(len(values)):
+        if algorithm == 'svd':
+            X[:,i], nvars[i], cutoffs[i] = svd_truncated_solution(D, VT, Utb, values[i])
+        else:
+            X[:,i]   = dot(transpose(VT), D * Utb / (D ** 2 + values[i]))
+            nvars[i] = VT.shape[1]
+            
+    return X, nvars, cutoffs
 
-            if mpistyle == "srun": 
-                exepath = "srun -N " + str(nodes) + " -n " + str(cores) + " " + dlars_file
-            elif mpistyle == "ibrun":
-                exepath = "ibrun" + " " + dlars_file  
-            else:
-                print("Unrecognized mpistyle:",args.mpistyle,". Recognized options are srun or ibrun")
-           
-            command = None
 
-            command = exepath + " " + A  + " " + b + " dim.txt --lambda=" + str(alpha)
+def print_sweep_table(algorithm, values, Y, b, nvars):
+## Print RMS force error, number of fitted variables and BIC for each sweep value as 
+## comment lines.  Y holds the (unweighted) predictions, one column per value.  Returns 
+## the index of the value with the lowest BIC.
 
-            #else:
-            #    command = ("{0} A.txt b.txt dim.txt --lambda={1}".format(exepath, alpha))
+    nlines = float(len(b))
+    Z      = numpy.sum((Y - b[:, numpy.newaxis]) ** 2, axis=0)
+    bic    = nlines * log(Z / nlines) + nvars * log(nlines)
+    best   = int(numpy.argmin(bic))
+    name   = "eps" if algorithm == 'svd' else "alpha"
+    
+    print ("! Regularization sweep over %s (%s algorithm)" % (name, algorithm))
+    print ("! %11s %15s %10s %15s" % (name, "RMS force err", "nvars", "BIC"))
+    
+    for i in range(len(values)):
+        print ("! %11.4e %15.4e %10d %15.4e" % (values[i], sqrt(Z[i] / nlines), nvars[i], bic[i]))
+        
+    print ("! Lowest BIC at %s = %11.4e" % (name, values[best]))
+    print ("!")
+    
+    return best
 
-            if ( split_files ) :
-                command = command + " --split_files"
-            if ( algorithm == 'dlars' ):
-                command = command + " --algorithm=lars"
-            elif ( algorithm == 'dlasso' ):
-                command = command + " --algorithm=lasso"
 
-            if ( weights != 'None' ):
-                command = command + " --weights=" + weights
+#############################################
+#############################################
+# Mixed precision
+#############################################
+#############################################
 
-            if ( normalize ):
-                command = command + " --normalize=y" 
-            else:
-                command = command + " --normalize=n" 
+def load_float32_matrix(mat_file, nrows, ncols, weights=None, chunk_values=1 << 21):
+## Read A (text, .npy sidecar or binary container) into a float32 array, a chunk at a time,
+## with row i scaled by weights[i] if given.
 
+    A = numpy.empty((nrows, ncols), dtype=numpy.float32)
+    
+    for (row, chunk) in iter_matrix_chunks(mat_file, nrows, ncols, chunk_values):
+    
+        end = row + chunk.shape[0]
+        
+        if weights is not None:
+            chunk = chunk * weights[row:end, numpy.newaxis]
+            
+        A[row:end] = chunk
+        
+    return A
+    
+
+def blocked_dot(A, x, block_rows=4096):
+## dot(A, x) in double precision for a float32 A, converting block_rows rows at a time.
+
+    y = numpy.empty(A.shape[0])
+    
+    for start in range(0, A.shape[0], block_rows):
+        y[start:start+block_rows] = dot(A[start:start+block_rows].astype(float), x)
+        
+    return y
+    
+
+def blocked_tdot(A, r, block_rows=4096):
+## dot(transpose(A), r) in double precision for a float32 A, converting block_rows rows at a time.
+
+    g = numpy.zeros(A.shape[1])
+    
+    for start in range(0, A.shape[0], block_rows):
+        g += dot(transpose(A[start:start+block_rows].astype(float)), r[start:start+block_rows])
+        
+    return g
+    
+
+def fit_mixed_precision(A, b, algorithm, eps, alpha, svd_driver, iter_limit=0, tol=1.0e-10):
+## Solve the (weighted) system for a float32 A.  A is factored in single precision, and the
+## solution is refined in double precision by LSQR, right-preconditioned with that factorization,
+## so that only a few products with A and A^T (blocked_dot, blocked_tdot) are needed:
+##
+## svd:            x = P z, P = V_k diag(1/D_k) for the singular values D > eps * max(D), 
+##                 minimizing ||A P z - b||.
+## ridge/cholesky: x = P z, P = R^-1 for the Cholesky factor R^T R = A^T A + (alpha + s) I 
+##                 (alpha = 0 for cholesky, s a small shift that keeps the float32 A^T A 
+##                 positive definite), minimizing ||A P z - b||^2 + alpha ||P z||^2.
+##
+## Returns x, the number of fitted variables, the svd cutoff (0 if unused), and the LSQR
+## stopping reason and number of iterations (at most iter_limit, or 10 * n if 0).
+
+    import scipy.sparse.linalg
+    
+    (m, n) = A.shape
+    
+    if algorithm == 'svd':
+    
+        D, VT, Utb = svd_factor(A, b.astype(numpy.float32), svd_driver)
+        
+        D      = D.astype(float)
+        cutoff = eps * D.max()
+        keep   = D > cutoff
+        V      = transpose(VT[keep]).astype(float)
+        D      = D[keep]
+        z0     = Utb[keep].astype(float)
+        damp   = 0.0
+        
+        precond  = lambda z: dot(V, z / D)
+        tprecond = lambda v: dot(transpose(V), v) / D
+        
+    else:
+    
+        G = dot(transpose(A), A).astype(float)
+        
+        if algorithm == 'ridge':
+            G += alpha * numpy.eye(n)
+            
+        # Rounding in the float32 product can leave G indefinite for an ill-conditioned A.  Only 
+        # the preconditioner is shifted (LSQR solves the unshifted problem): by the float32 
+        # precision times the mean diagonal of G, increased tenfold until R exists.
+        
+        shift = numpy.finfo(numpy.float32).eps * numpy.trace(G) / n
+        R     = None
+        
+        for attempt in range(6):
+            try:
+                R = scipy.linalg.cholesky(G + shift * numpy.eye(n), lower=False)
+                break
+            except numpy.linalg.LinAlgError:
+                shift *= 10.0
+                
+        if R is None:
+            sys.stderr.write("Cholesky factorization failed: the normal equations are not positive definite. Try --algorithm=svd or ridge\n")
+            exit(1)
+            
+        cutoff = 0.0
+        damp   = sqrt(alpha) if algorithm == 'ridge' else 0.0
+        
+        precond  = lambda z: scipy.linalg.solve_triangular(R, z)
+        tprecond = lambda v: scipy.linalg.solve_triangular(R, v, trans='T')
+        z0       = tprecond(blocked_tdot(A, b))
+        
+    k = len(z0)
+    
+    op = scipy.sparse.linalg.LinearOperator((m + n, k), dtype=float,
+                                            matvec=lambda z: numpy.concatenate((blocked_dot(A, precond(z)), damp * precond(z))),
+                                            rmatvec=lambda r: tprecond(blocked_tdot(A, r[:m]) + damp * r[m:]))
+                                            
+    out = scipy.sparse.linalg.lsqr(op, numpy.concatenate((b, numpy.zeros(n))), atol=tol, btol=tol, 
+                                   iter_lim=iter_limit if iter_limit > 0 else 10 * n, x0=z0)
+                                   
+    return precond(out[0]), k, cutoff, int(out[1]), int(out[2])
+
+
+#############################################
+#############################################
+# Out-of-core normal equations
+#############################################
+#############################################
+
+def split_matrix_files(path="."):
+## List the per-rank A files written by chimes_lsq with SPLITFI, as (A file, first row, 
+## number of rows, param_count) tuples ordered by first row.  A binary container 
+## A.%04d.bin (see write_split_binary_matrices) is used in place of A.%04d.txt when it 
+## matches dim.%04d.txt and is not older than the text file.
+
+    files = []
+    
+    for dim_file in glob.glob(os.path.join(path, "dim.[0-9][0-9][0-9][0-9].txt")):
+    
+        rank = os.path.basename(dim_file)[4:8]
+        (param_count, start, end, total) = read_dim_file(dim_file)
+        
+        A_file = os.path.join(path, "A." + rank + ".bin")
+        
+        if not current_split_binary(A_file, os.path.join(path, "A." + rank + ".txt"), [param_count, start, end, total]):
+            A_file = os.path.join(path, "A." + rank + ".txt")
+            
+        files.append((A_file, start, end - start + 1, param_count))
+        
+    files.sort(key=lambda item: item[1])
+    
+    if len(files) == 0:
+        sys.stderr.write("Error: no dim.%04d.txt files found for split A matrix\n")
+        exit(1)
+    
+    return files
+
+
+def current_split_binary(bin_file, txt_file, dim):
+## True if the binary container bin_file exists, holds the rows given by the dim.%04d.txt 
+## fields dim, and is not older than the text A file txt_file it was converted from.
+
+    if not os.path.exists(bin_file):
+        return False
+        
+    if os.path.exists(txt_file) and os.path.getmtime(bin_file) < os.path.getmtime(txt_file):
+        sys.stderr.write("Warning: " + bin_file + " is older than " + txt_file + "; reading the text file\n")
+        return False
+        
+    if open_binary_matrix(bin_file)[2] != dim:
+        sys.stderr.write("Warning: " + bin_file + " does not match its dim file; reading the text file\n")
+        return False
+        
+    return True
+
+
+def split_binary_worker(task):
+## Convert one split A file and its rows of b to a binary container.
+
+    (A_file, bin_file, param_count, start, nrows, total, b_rows) = task
+    
+    write_binary_matrix(bin_file, load_matrix(A_file, nrows, param_count, cache=False), b_rows, start, total)
+    
+
+def write_split_binary_matrices(out_dir, b, workers):
+## Convert each split A file A.%04d.txt, with its rows of b (the first column, for several 
+## targets), to a binary container out_dir/A.%04d.bin that keeps the dim.%04d.txt fields.  
+## The dim.%04d.txt files are copied to out_dir, so that split_matrix_files(out_dir) uses 
+## the containers.  Returns the number of files converted.
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+        
+    b     = numpy.asarray(b)
+    tasks = []
+    
+    for dim_file in sorted(glob.glob("dim.[0-9][0-9][0-9][0-9].txt")):
+    
+        rank = dim_file[4:8]
+        (param_count, start, end, total) = read_dim_file(dim_file)
+        
+        b_rows = b[start:end+1] if b.ndim == 1 else b[start:end+1, 0]
+        
+        tasks.append(("A." + rank + ".txt", os.path.join(out_dir, "A." + rank + ".bin"), param_count, start, end - start + 1, total, b_rows))
+        
+        if os.path.abspath(out_dir) != os.path.abspath("."):
+            shutil.copy(dim_file, out_dir)
+            
+    for item in ordered_map(split_binary_worker, tasks, workers):
+        pass
+        
+    return len(tasks)
+
+
+def normal_equations_worker(task):
+## Accumulate (weighted A)^T (weighted A) and (weighted A)^T (weighted b) over one split A file.
+## b may have several columns.
+
+    (A_file, nrows, ncols, b_rows, w_rows) = task
+    
+    G = numpy.zeros((ncols, ncols))
+    c = numpy.zeros((ncols,) + b_rows.shape[1:])
+    
+    for (row, chunk) in iter_matrix_chunks(A_file, nrows, ncols):
+        b_chunk = b_rows[row:row+chunk.shape[0]]
+        
+        if w_rows is not None:
+            w_chunk = w_rows[row:row+chunk.shape[0]]
+            chunk   = chunk * w_chunk[:, numpy.newaxis]
+            b_chunk = b_chunk * (w_chunk if b_chunk.ndim == 1 else w_chunk[:, numpy.newaxis])
+            
+        G += dot(transpose(chunk), chunk)
+        c += dot(transpose(chunk), b_chunk)
+        
+    return G, c
+
+
+def accumulate_normal_equations(split_files, b, weights, workers, comm=None):
+## Sum the per-file normal equations in file order.  weights may be None.  With an MPI 
+## communicator, the sums of all ranks are all-reduced.
+
+    tasks = []
+    
+    for (A_file, start, nrows, ncols) in split_files:
+        w_rows = None if weights is None else weights[start:start+nrows]
+        tasks.append((A_file, nrows, ncols, b[start:start+nrows], w_rows))
+        
+    G = None
+    c = None
+    
+    for (G_file, c_file) in ordered_map(normal_equations_worker, tasks, workers):
+        if G is None:
+            G = G_file
+            c = c_file
+        else:
+            G += G_file
+            c += c_file
+            
+    if comm is not None:
+        G = mpi_allreduce(G, comm)
+        c = mpi_allreduce(c, comm)
+            
+    return G, c
+
+
+def solve_normal_equations(G, c, algorithm, eps, alpha):
+## Solve G x = c (c may have several columns).  Returns x, the number of fitted variables 
+## and the SVD cutoff (0 if unused).
+##
+## svd:      eigendecomposition of G = V D^2 V^T, with the singular values D cut off at 
+##           eps * max(D) as in the svd branch of main.  Because G squares the condition 
+##           number, cutoffs below ~1e-7 are lost in round-off.
+## ridge:    (G + alpha I) x = c, the same objective as sklearn Ridge without intercept.
+## cholesky: G x = c, for well-conditioned problems.
+
+    if algorithm == 'svd':
+        
+        lam, V = scipy.linalg.eigh(G)
+        D      = sqrt(numpy.clip(lam, 0.0, None))
+        cutoff = eps * D.max()
+        keep   = D > cutoff
+        
+        x = dot(V[:,keep], transpose(transpose(dot(transpose(V[:,keep]), c)) / lam[keep]))
+        
+        return x, int(numpy.count_nonzero(keep)), cutoff
+        
+    if algorithm == 'ridge':
+        G = G + alpha * numpy.eye(G.shape[0])
+        
+    try:
+        x = scipy.linalg.cho_solve(scipy.linalg.cho_factor(G, lower=True), c)
+    except numpy.linalg.LinAlgError:
+        sys.stderr.write("Cholesky factorization failed: the normal equations are not positive definite. Try --algorithm=svd or ridge\n")
+        exit(1)
+        
+    return x, G.shape[0], 0.0
+
+
+def normal_equations_svd(G, c):
+## SVD factors of the (weighted) A implied by the normal equations G = A^T A, c = A^T b: 
+## returns D, VT and U^T b as svd_factor does, from the eigendecomposition G = V D^2 V^T.
+
+    lam, V = scipy.linalg.eigh(G)
+    D      = sqrt(numpy.clip(lam, 0.0, None))
+    Utb    = numpy.zeros(len(D))
+    pos    = D > 0.0
+    
+    Utb[pos] = dot(transpose(V[:,pos]), c) / D[pos]
+    
+    return D, transpose(V), Utb
+
+
+def predict_worker(task):
+## Return dot(A, x) for one split A file.
+
+    (A_file, nrows, ncols, x) = task
+    
+    y = numpy.empty((nrows,) + x.shape[1:])
+    
+    for (row, chunk) in iter_matrix_chunks(A_file, nrows, ncols):
+        y[row:row+chunk.shape[0]] = dot(chunk, x)
+        
+    return y
+
+
+def predict_split_files(split_files, x, workers, comm=None):
+## Predicted forces dot(A, x) for the full split A matrix, in row order.  x may hold 
+## several solutions as columns.  With an MPI communicator, each rank predicts the rows 
+## of its own files and rank 0 returns the gathered result (None on other ranks).
+
+    tasks = [(A_file, nrows, ncols, x) for (A_file, start, nrows, ncols) in split_files]
+    
+    y = numpy.concatenate(list(ordered_map(predict_worker, tasks, workers)))
+    
+    if comm is None:
+        return y
+        
+    return mpi_gather_rows(split_files, y, comm)
+
+
+def rmatvec_worker(task):
+## Return dot(A^T, r) for one split A file, where r holds the rows of that file.
+
+    (A_file, nrows, ncols, r_rows) = task
+    
+    Atr = numpy.zeros(ncols)
+    
+    for (row, chunk) in iter_matrix_chunks(A_file, nrows, ncols):
+        Atr += dot(r_rows[row:row+chunk.shape[0]], chunk)
+        
+    return Atr
+
+
+def rmatvec_split_files(split_files, r, workers):
+## dot(A^T, r) for the full split A matrix, summed in file order.
+
+    tasks = [(A_file, nrows, ncols, r[start:start+nrows]) for (A_file, start, nrows, ncols) in split_files]
+    
+    return numpy.sum(list(ordered_map(rmatvec_worker, tasks, workers)), axis=0)
+
+
+#############################################
+#############################################
+# MPI ranks
+#############################################
+#############################################
+
+def mpi_comm():
+## MPI_COMM_WORLD, for --mpi runs.  mpi4py is only imported when requested.
+
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        sys.stderr.write("Error: --mpi requires the mpi4py package\n")
+        exit(1)
+        
+    return MPI.COMM_WORLD
+
+
+def mpi_rank_files(split_files, comm):
+## The split A files read by this rank.  With one A.%04d.txt file per rank (as written by a 
+## chimes_lsq run on the same number of ranks), rank k reads A.k.txt; otherwise the files are 
+## dealt out round-robin in row order.
+
+    if len(split_files) < comm.Get_size():
+        sys.stderr.write("Error: more MPI ranks (" + str(comm.Get_size()) + ") than split A files (" + str(len(split_files)) + ")\n")
+        exit(1)
+        
+    return split_files[comm.Get_rank()::comm.Get_size()]
+
+
+def mpi_allreduce(arr, comm):
+## Element-wise sum of arr over all ranks.
+
+    from mpi4py import MPI
+    
+    arr   = numpy.ascontiguousarray(arr)
+    total = numpy.empty_like(arr)
+    
+    comm.Allreduce(arr, total, op=MPI.SUM)
+    
+    return total
+
+
+def mpi_gather_rows(split_files, y, comm):
+## Assemble the rows y of each rank's split files, in row order, on rank 0.  Returns None 
+## on the other ranks.
+
+    pieces = comm.gather((split_files, y), root=0)
+    
+    if comm.Get_rank() != 0:
+        return None
+        
+    nrows_total = numpy.max([start + nrows for (rank_files, y_rank) in pieces for (A_file, start, nrows, ncols) in rank_files])
+    y_all       = numpy.empty((nrows_total,) + y.shape[1:])
+    
+    for (rank_files, y_rank) in pieces:
+        row = 0
+        
+        for (A_file, start, nrows, ncols) in rank_files:
+            y_all[start:start+nrows] = y_rank[row:row+nrows]
+            row += nrows
+            
+    return y_all
+
+
+#############################################
+#############################################
+# Tall-skinny QR
+#############################################
+#############################################
+
+def qr_stack(R_top, Qtb_top, R_bot, Qtb_bot):
+## R factor and Q^T b of the stacked system [R_top; R_bot] x = [Qtb_top; Qtb_bot].  
+## R_top may be None.  The returned R is square (zero rows are added while fewer 
+## rows than columns have been seen).
+
+    if R_top is None:
+        M = R_bot
+        c = Qtb_bot
+    else:
+        M = numpy.vstack((R_top, R_bot))
+        c = numpy.concatenate((Qtb_top, Qtb_bot))
+        
+    Qtb, R = scipy.linalg.qr_multiply(M, c, mode='right', overwrite_a=True)
+    
+    if R.shape[0] < R.shape[1]:
+        R   = numpy.vstack((R, numpy.zeros((R.shape[1] - R.shape[0], R.shape[1]))))
+        Qtb = numpy.concatenate((Qtb, numpy.zeros(R.shape[1] - len(Qtb))))
+        
+    return R, Qtb
+
+
+def tsqr_worker(task):
+## Factor the weighted rows of one A file, chunk by chunk: returns its R factor and Q^T b.
+
+    (A_file, nrows, ncols, b_rows, w_rows) = task
+    
+    R   = None
+    Qtb = None
+    
+    for (row, chunk) in iter_matrix_chunks(A_file, nrows, ncols):
+        b_chunk = b_rows[row:row+chunk.shape[0]]
+        
+        if w_rows is not None:
+            chunk   = chunk   * w_rows[row:row+chunk.shape[0], numpy.newaxis]
+            b_chunk = b_chunk * w_rows[row:row+chunk.shape[0]]
+            
+        R, Qtb = qr_stack(R, Qtb, numpy.array(chunk), b_chunk)
+        
+    return R, Qtb
+
+
+def tsqr_merge_worker(task):
+## Merge two (R, Q^T b) pairs of the reduction tree.
+
+    (R_top, Qtb_top, R_bot, Qtb_bot) = task
+    
+    return qr_stack(R_top, Qtb_top, R_bot, Qtb_bot)
+
+
+def tsqr_factor(files, b, weights, workers, comm=None):
+## Tall-skinny QR of the weighted A over a list of A files.  Each file is factored in its 
+## own worker; the R factors are then merged pairwise, in file order, level by level of a 
+## binary reduction tree.  Returns the np x np R and Q^T b.  With an MPI communicator, 
+## the R factors of all ranks are all-gathered (in rank order) before the reduction, so 
+## every rank ends with the same R.
+
+    tasks = []
+    
+    for (A_file, start, nrows, ncols) in files:
+        w_rows = None if weights is None else weights[start:start+nrows]
+        tasks.append((A_file, nrows, ncols, b[start:start+nrows], w_rows))
+        
+    level = list(ordered_map(tsqr_worker, tasks, workers))
+    
+    if comm is not None:
+        level = [pair for rank_level in comm.allgather(level) for pair in rank_level]
+    
+    while len(level) > 1:
+        pairs = [level[i] + level[i+1] for i in range(0, len(level) - 1, 2)]
+        odd   = [level[-1]] if len(level) % 2 == 1 else []
+        level = list(ordered_map(tsqr_merge_worker, pairs, workers)) + odd
+        
+    return level[0]
+
+
+def solve_r_factor(R, Qtb, eps):
+## Solve R x = Q^T b.  When no singular value of R falls below eps * max, this is a plain
+## triangular solve; otherwise the truncated SVD of R is used, matching the svd algorithm.
+## Returns x, the number of fitted variables and the SVD cutoff.
+
+    D, VT, Utb = svd_factor(R, Qtb, "gesdd")
+    
+    x, nvars, cutoff = svd_truncated_solution(D, VT, Utb, eps)
+    
+    if nvars == R.shape[1]:
+        x = scipy.linalg.solve_triangular(R, Qtb)
+        
+    return x, nvars, cutoff
+
+
+#############################################
+#############################################
+# Factorization cache
+#############################################
+#############################################
+
+# Each entry of a --factor_cache directory is an .npz file named by the SHA-1 of the 
+# factorization kind and the contents of its input files.  index.json records the size 
+# and last use of every entry, and memoizes the content hash of each input file against 
+# its size and modification time, so unchanged files are only hashed once.
+
+FACTOR_CACHE_INDEX = "index.json"
+
+def read_factor_cache_index(cache_dir):
+## The index of cache_dir; an empty index if it is missing or unreadable.
+
+    try:
+        with open(os.path.join(cache_dir, FACTOR_CACHE_INDEX), "r") as indexf:
+            index = json.load(indexf)
+    except (OSError, ValueError):
+        index = {}
+        
+    index.setdefault("files",   {})
+    index.setdefault("entries", {})
+    
+    return index
+
+
+def write_factor_cache_index(cache_dir, index):
+
+    tmp_file = os.path.join(cache_dir, FACTOR_CACHE_INDEX + ".tmp")
+    
+    with open(tmp_file, "w") as indexf:
+        json.dump(index, indexf)
+        
+    os.replace(tmp_file, os.path.join(cache_dir, FACTOR_CACHE_INDEX))
+
+
+def file_content_hash(path, index, block_size=1 << 24):
+## SHA-1 of the contents of path, memoized in index by size and modification time.
+
+    if not os.path.exists(path):
+        return "missing"
+    
+    path = os.path.realpath(path)
+    st   = os.stat(path)
+    memo = index["files"].get(path)
+    
+    if memo is not None and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+        return memo[2]
+        
+    h = hashlib.sha1()
+    
+    with open(path, "rb") as inf:
+        while True:
+            block = inf.read(block_size)
+            if not block:
+                break
+            h.update(block)
+            
+    index["files"][path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+    
+    return h.hexdigest()
+
+
+def evict_factor_cache(cache_dir, index, max_bytes, keep):
+## Remove least recently used entries (other than keep) until the cache fits in max_bytes.
+
+    entries = index["entries"]
+    total   = numpy.sum([entry["bytes"] for entry in entries.values()])
+    
+    for key in sorted(entries, key=lambda k: entries[k]["used"]):
+        
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+            
+        try:
+            os.remove(os.path.join(cache_dir, key + ".npz"))
+        except OSError:
+            pass
+            
+        total -= entries[key]["bytes"]
+        del entries[key]
+
+
+def cached_factorization(cache_dir, max_gb, kind, files, compute):
+## Return the tuple of arrays computed by compute(), e.g. the (D, VT, U^T b) of an SVD, from 
+## the cache in cache_dir when it holds an entry for kind and the contents of files; 
+## otherwise call compute() and store the result.  With an empty cache_dir, compute() is 
+## simply called.
+
+    if cache_dir == "":
+        return compute()
+        
+    os.makedirs(cache_dir, exist_ok=True)
+    
+    index = read_factor_cache_index(cache_dir)
+    h     = hashlib.sha1(kind.encode())
+    
+    for path in files:
+        h.update(file_content_hash(path, index).encode())
+        
+    key        = h.hexdigest()
+    entry_file = os.path.join(cache_dir, key + ".npz")
+    
+    if key in index["entries"] and os.path.exists(entry_file):
+    
+        print ("! Factorization cache hit        = ", key)
+        
+        with numpy.load(entry_file) as entry:
+            result = tuple(entry["arr_%d" % i] for i in range(len(entry.files)))
+            
+    else:
+    
+        result = compute()
+        
+        numpy.savez(entry_file + ".tmp.npz", *result)
+        os.replace(entry_file + ".tmp.npz", entry_file)
+        
+        index["entries"][key] = {"kind" : kind, "bytes" : os.path.getsize(entry_file)}
+        
+    index["entries"][key]["used"] = datetime.now().timestamp()
+    
+    evict_factor_cache(cache_dir, index, max_gb * 1.0e9, key)
+    write_factor_cache_index(cache_dir, index)
+    
+    return result
+
+
+#############################################
+#############################################
+# Persistent fit state (--append)
+#############################################
+#############################################
+
+# The fit state holds the R factor and Q^T b of the weighted A; the unweighted normal 
+# equations (for the RMS force error) with per-column sums and nonzero counts; and, for 
+# each A file, its first row, the number of rows factored so far and a copy of the last 
+# of them.  A hash of the factored rows of b and the weights detects changed inputs.
+
+FIT_STATE_VERSION = 1
+
+def empty_fit_state(ncols):
+## Fit state before any rows have been factored.
+
+    return {"version"   : numpy.array(FIT_STATE_VERSION),
+            "R"         : numpy.zeros((ncols, ncols)),
+            "Qtb"       : numpy.zeros(ncols),
+            "G"         : numpy.zeros((ncols, ncols)),
+            "c"         : numpy.zeros(ncols),
+            "bb"        : numpy.array(0.0),
+            "col_sum"   : numpy.zeros(ncols),
+            "col_nnz"   : numpy.zeros(ncols, dtype=int),
+            "files"     : numpy.array([], dtype=str),
+            "starts"    : numpy.zeros(0, dtype=int),
+            "rows"      : numpy.zeros(0, dtype=int),
+            "tails"     : numpy.zeros((0, ncols)),
+            "rows_hash" : numpy.array("")}
+
+
+def fit_state_rows_hash(prefix, b, weights):
+## Hash of b (and the weights, if used) over the (start, rows) ranges in prefix.
+
+    h = hashlib.sha1()
+    
+    for (start, rows) in prefix:
+        h.update(numpy.ascontiguousarray(b[start:start+rows]).tobytes())
+        if weights is not None:
+            h.update(numpy.ascontiguousarray(weights[start:start+rows]).tobytes())
+            
+    h.update(b"weighted" if weights is not None else b"unweighted")
+    
+    return h.hexdigest()
+
+
+def fit_state_worker(task):
+## Factor the rows of one A file from first_row on.  The row before first_row must equal 
+## tail, the last row factored in the previous fit; None is returned if it does not.
+
+    (A_file, nrows, ncols, b_rows, w_rows, first_row, tail) = task
+    
+    R       = numpy.zeros((ncols, ncols))
+    Qtb     = numpy.zeros(ncols)
+    G       = numpy.zeros((ncols, ncols))
+    c       = numpy.zeros(ncols)
+    bb      = 0.0
+    col_sum = numpy.zeros(ncols)
+    col_nnz = numpy.zeros(ncols, dtype=int)
+    
+    if first_row > nrows:
+        return None
+    
+    skip = first_row - 1 if first_row > 0 else 0
+    
+    for (row, chunk) in iter_matrix_chunks(A_file, nrows, ncols, first_row=skip):
+    
+        if first_row > 0 and row == skip:
+            if not numpy.array_equal(chunk[0], tail):
+                return None
+            chunk = chunk[1:]
+            row  += 1
+            
+        if chunk.shape[0] == 0:
+            continue
+            
+        b_chunk = b_rows[row:row+chunk.shape[0]]
+        
+        G       += dot(transpose(chunk), chunk)
+        c       += dot(transpose(chunk), b_chunk)
+        bb      += dot(b_chunk, b_chunk)
+        col_sum += chunk.sum(axis=0)
+        col_nnz += numpy.count_nonzero(chunk, axis=0)
+        tail     = numpy.array(chunk[-1])
+        
+        if w_rows is not None:
+            chunk   = chunk   * w_rows[row:row+chunk.shape[0], numpy.newaxis]
+            b_chunk = b_chunk * w_rows[row:row+chunk.shape[0]]
+            
+        R, Qtb = qr_stack(R, Qtb, numpy.array(chunk), b_chunk)
+        
+    return R, Qtb, G, c, bb, col_sum, col_nnz, tail
+
+
+def update_fit_state(state, files, b, weights, workers):
+## Add the rows appended to each A file since state was saved.  Returns the updated state 
+## and the number of new rows, or None if the A files, b or the weights changed in the 
+## rows already factored.
+
+    old   = dict(zip(state["files"], zip(state["starts"], state["rows"], state["tails"])))
+    names = [os.path.basename(A_file) for (A_file, start, nrows, ncols) in files]
+    
+    if len([name for name in old if name not in names]) > 0:   # A file removed
+        return None
+    
+    tasks  = []
+    prefix = []
+    
+    for (name, (A_file, start, nrows, ncols)) in zip(names, files):
+    
+        (old_start, old_rows, tail) = old.get(name, (start, 0, numpy.zeros(ncols)))
+        
+        if old_start != start or old_rows > nrows:
+            return None
+            
+        w_rows = None if weights is None else weights[start:start+nrows]
+        
+        prefix.append((start, old_rows))
+        tasks.append((A_file, nrows, ncols, b[start:start+nrows], w_rows, old_rows, tail))
+        
+    if len(old) > 0 and fit_state_rows_hash(prefix, b, weights) != str(state["rows_hash"]):
+        return None
+        
+    state = dict(state)
+    tails = []
+    
+    for item in ordered_map(fit_state_worker, tasks, workers):
+    
+        if item is None:
+            return None
+            
+        (R, Qtb, G, c, bb, col_sum, col_nnz, tail) = item
+        
+        state["R"], state["Qtb"] = qr_stack(state["R"], state["Qtb"], R, Qtb)
+        
+        state["G"]       = state["G"]  + G
+        state["c"]       = state["c"]  + c
+        state["bb"]      = numpy.array(state["bb"] + bb)
+        state["col_sum"] = state["col_sum"] + col_sum
+        state["col_nnz"] = state["col_nnz"] + col_nnz
+        
+        tails.append(tail)
+        
+    new_rows = sum([nrows for (A_file, start, nrows, ncols) in files]) - sum([rows for (start, rows) in prefix])
+        
+    state["files"]     = numpy.array(names)
+    state["starts"]    = numpy.array([start for (A_file, start, nrows, ncols) in files])
+    state["rows"]      = numpy.array([nrows for (A_file, start, nrows, ncols) in files])
+    state["tails"]     = numpy.array(tails)
+    state["rows_hash"] = numpy.array(fit_state_rows_hash([(start, nrows) for (A_file, start, nrows, ncols) in files], b, weights))
+    
+    return state, new_rows
+    
+
+def append_fit_state(state_file, files, b, weights, ncols, workers):
+## Read the fit state from state_file (if any), add the new rows of the A files and write
+## it back.  A missing or mismatched state is rebuilt from all rows.  Returns the state and
+## the number of rows factored.
+
+    state = empty_fit_state(ncols)
+    
+    if os.path.exists(state_file):
+        with numpy.load(state_file) as saved:
+            saved = dict(saved)
+            
+        if int(saved["version"]) == FIT_STATE_VERSION and saved["R"].shape == (ncols, ncols):
+            state = saved
+        else:
+            print ("! Fit state " + state_file + " does not match the number of variables; refactorizing")
+            
+    result = update_fit_state(state, files, b, weights, workers)
+    
+    if result is None:
+        print ("! A, b or weights changed in previously factored rows; refactorizing")
+        result = update_fit_state(empty_fit_state(ncols), files, b, weights, workers)
+        
+    state, new_rows = result
+    
+    numpy.savez(state_file + ".tmp.npz", **state)
+    os.replace(state_file + ".tmp.npz", state_file)
+    
+    return state, new_rows
+
+
+def solve_fit_state(state, algorithm, eps, alpha):
+## Solve from the R factor of a fit state: svd and tsqr as solve_r_factor, ridge and cholesky 
+## from the normal equations R^T R x = R^T Q^T b.
+
+    if algorithm in ("svd", "tsqr"):
+        return solve_r_factor(state["R"], state["Qtb"], eps)
+        
+    G = dot(transpose(state["R"]), state["R"])
+    c = dot(transpose(state["R"]), state["Qtb"])
+    
+    return solve_normal_equations(G, c, algorithm, eps, alpha)
+
+
+def fit_state_residual(state, x):
+## Unweighted sum of squared residuals |A x - b|^2 from the normal equations in state.
+
+    Z = dot(x, dot(state["G"], x)) - 2.0 * dot(x, state["c"]) + float(state["bb"])
+    
+    return numpy.maximum(Z, 0.0)
+
+
+#############################################
+#############################################
+# Randomized sketching solver
+#############################################
+#############################################
+
+def sketch_worker(task):
+## Sketch the weighted rows of one A file: returns (S A, S b) for this file's rows.  The 
+## random numbers for each chunk are seeded by its global first row, so the sketch does 
+## not depend on the number of workers.
+
+    (A_file, start, nrows, ncols, b_rows, w_rows, kind, m, seed) = task
+    
+    import scipy.sparse
+    
+    SA = numpy.zeros((m, ncols))
+    Sb = numpy.zeros(m)
+    
+    for (row, chunk) in iter_matrix_chunks(A_file, nrows, ncols):
+        k       = chunk.shape[0]
+        b_chunk = b_rows[row:row+k]
+        
+        if w_rows is not None:
+            chunk   = chunk   * w_rows[row:row+k, numpy.newaxis]
+            b_chunk = b_chunk * w_rows[row:row+k]
+            
+        rng = numpy.random.default_rng([seed, start + row])
+        
+        if kind == "gaussian":
+            S = rng.standard_normal((m, k)) / sqrt(m)
+        else:   # countsketch: each row is added, with a random sign, to one random sketch row
+            S = scipy.sparse.csr_matrix((rng.choice([-1.0, 1.0], k), (rng.integers(0, m, k), numpy.arange(k))), shape=(m, k))
+            
+        SA += S @ chunk
+        Sb += S @ b_chunk
+        
+    return SA, Sb
+
+
+def fit_sketch(files, b, weights, kind, m, iters, check, eps, svd_driver, workers, seed=0):
+## Randomized least squares for very tall A.  The weighted system is compressed to m rows 
+## with a streamed CountSketch or Gaussian projection and solved with the truncated SVD.
+## Optionally, iters LSQR iterations against the full A follow, preconditioned by the 
+## sketch's SVD (x = V D^-1 z), and the residual is compared with the exact solution of 
+## the normal equations.  Returns x, the number of fitted variables and the predictions.
+
+    import scipy.sparse.linalg
+
+    ncols = files[0][3]
+    
+    if kind not in ("countsketch", "gaussian"):
+        print ("Unrecognized sketch: " + kind + ". Recognized options are countsketch and gaussian")
+        exit(1)
+        
+    if m < 1:
+        m = (16 if kind == "countsketch" else 4) * ncols
+        
+    print ("! Randomized sketch solver used (%s, %d sketch rows)" % (kind, m))
+    
+    tasks = []
+    
+    for (A_file, start, nrows, ncols) in files:
+        w_rows = None if weights is None else weights[start:start+nrows]
+        tasks.append((A_file, start, nrows, ncols, b[start:start+nrows], w_rows, kind, m, seed))
+    
+    SA = numpy.zeros((m, ncols))
+    Sb = numpy.zeros(m)
+    
+    for (SA_file, Sb_file) in ordered_map(sketch_worker, tasks, workers):
+        SA += SA_file
+        Sb += Sb_file
+        
+    D, VT, Utb     = svd_factor(SA, Sb, svd_driver, overwrite_a=True)
+    x, nvars, cutoff = svd_truncated_solution(D, VT, Utb, eps)
+    
+    print ("! eps (= args.eps*dmax)          =  %11.4e" % cutoff)        
+    print ("! SVD regularization factor      = %11.4e" % eps)
+    
+    wb = b if weights is None else b * weights
+    
+    if iters > 0:
+    
+        keep = numpy.abs(D) > cutoff
+        P    = transpose(VT[keep]) / D[keep]     # Right preconditioner
+        
+        def matvec(z):
+            y = predict_split_files(files, dot(P, numpy.ravel(z)), workers)
+            return y if weights is None else y * weights
+            
+        def rmatvec(r):
+            r = numpy.ravel(r)
+            return dot(transpose(P), rmatvec_split_files(files, r if weights is None else r * weights, workers))
+        
+        op = scipy.sparse.linalg.LinearOperator((len(b), P.shape[1]), matvec=matvec, rmatvec=rmatvec)
+        z  = scipy.sparse.linalg.lsqr(op, wb, iter_lim=iters, x0=Utb[keep])
+        x  = dot(P, z[0])
+        
+        print ("! LSQR refinement iterations     = %d" % z[2])
+        
+    if not check:
+        return x, nvars, predict_split_files(files, x, workers)
+        
+    # Compare with the exact solution of the same weighted problem
+    
+    G, c     = accumulate_normal_equations(files, b, weights, workers)
+    x_exact  = solve_normal_equations(G, c, 'svd', eps, 0.0)[0]
+    Y        = predict_split_files(files, numpy.column_stack((x, x_exact)), workers)
+    R        = Y - b[:, numpy.newaxis]
+    
+    if weights is not None:
+        R *= weights[:, numpy.newaxis]
+        
+    res = sqrt(numpy.sum(R ** 2, axis=0))
+    
+    print ("! Sketch solution residual norm  = %11.4e" % res[0])
+    print ("! Exact solution residual norm   = %11.4e" % res[1])
+    print ("! Relative residual excess       = %11.4e" % ((res[0] - res[1]) / res[1]))
+    
+    return x, nvars, Y[:,0]
+
+
+#############################################
+#############################################
+# Weighting helpers
+#############################################
+#############################################
+
+def apply_row_weights(A, weights, block_rows=4096):
+## Scale row i of A by weights[i] in place, block_rows rows at a time.  Rows with zero 
+## weight cannot be recovered by dividing by the weight afterwards, so a copy of those 
+## (usually few) rows is returned as (row indices, original rows).  A may also be a 
+## scipy.sparse CSR matrix, whose stored values are scaled.
+
+    zero_idx  = numpy.flatnonzero(weights == 0.0)
+    
+    if scipy.sparse.issparse(A):
+        zero_rows = A[zero_idx]
+        A.data   *= numpy.repeat(weights, numpy.diff(A.indptr))
+        return zero_idx, zero_rows
+        
+    zero_rows = numpy.array(A[zero_idx])
+    
+    for start in range(0, A.shape[0], block_rows):
+        end = start + block_rows
+        A[start:end] *= weights[start:end, numpy.newaxis]
+        
+    return zero_idx, zero_rows
+
+
+def unweight_predictions(y, x, weights, zero_weight):
+## Turn y = dot(weighted A, x) into the unweighted predictions dot(A, x), using the rows
+## saved by apply_row_weights where the weight is zero.
+
+    (zero_idx, zero_rows) = zero_weight
+    
+    nonzero    = weights != 0.0
+    
+    if y.ndim == 1:
+        y[nonzero] = y[nonzero] / weights[nonzero]
+    else:           # Several solutions, one per column
+        y[nonzero] = y[nonzero] / weights[nonzero, numpy.newaxis]
+    
+    if len(zero_idx) > 0:
+        y[zero_idx] = zero_rows.dot(x)
+        
+    return y
+
+
+#############################################
+#############################################
+# Matrix I/O helpers
+#############################################
+#############################################
+
+def read_dim_file(dim_file):
+## Read the dimensions written by chimes_lsq.  dim.txt holds "param_count total", while
+## the split-file dim.%04d.txt files hold "param_count start end total".
+    with open(dim_file, "r") as dimf:
+        return [int(x) for x in next(dimf).split()]
+
+
+def count_matrix_dims(mat_file):
+## Count the rows and columns of a whitespace-delimited text matrix without parsing it.
+## Rows are found by counting newlines in large binary blocks.
+    ncols = 0
+    nrows = 0
+    last  = b"\n"
+    
+    with open(mat_file, "rb") as matf:
+        ncols = len(matf.readline().split())
+        matf.seek(0)
+        
+        while True:
+            block = matf.read(1 << 24)
+            if not block:
+                break
+            nrows += block.count(b"\n")
+            last   = block[-1:]
+            
+    if last != b"\n":   # No newline after the final row
+        nrows += 1
+        
+    return nrows, ncols
+    
+
+def binary_cache_key(mat_file):
+## Key used to decide whether a binary sidecar is still valid for mat_file.
+    st = os.stat(mat_file)
+    return "%d %d" % (st.st_size, st.st_mtime_ns)
+
+
+def remove_partial_file(path):
+## Remove a partly written cache file, if any.  Errors are ignored: the cache is optional.
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def valid_binary_cache(mat_file):
+## True if the .npy sidecar written by load_matrix for mat_file is up to date.
+    keyfile = mat_file + ".npy.key"
+    
+    if not (os.path.exists(mat_file + ".npy") and os.path.exists(keyfile)):
+        return False
+        
+    with open(keyfile, "r") as keyf:
+        return keyf.read().strip() == binary_cache_key(mat_file)
+
+
+def load_matrix(mat_file, nrows=None, ncols=None, cache=False, chunk_values=1 << 21):
+## Read a text matrix in the A_Matrix.C output format (%.16e, space separated) into a 
+## preallocated float64 array.  The file is parsed chunk_values numbers at a time, so the 
+## peak memory stays close to the size of the final array.  nrows and ncols are taken 
+## from dim.txt when available and counted from the file otherwise.  Single-column files 
+## (b.txt, weights) are returned as 1-D arrays, as numpy.genfromtxt does.
+##
+## With cache=True, a <mat_file>.npy sidecar keyed on the size and mtime of mat_file is 
+## written after parsing, and read instead of the text file on later calls.  A sidecar that
+## cannot be written (e.g. in a read-only directory) is skipped with a warning.
+
+    sidecar = mat_file + ".npy"
+    keyfile = mat_file + ".npy.key"
+    
+    if cache and valid_binary_cache(mat_file):
+        mat = numpy.load(sidecar)
+        if (nrows is None or mat.shape[0] == nrows) and (ncols is None or mat.ndim == 1 or mat.shape[1] == ncols):
+            return mat
+    
+    # Column count always comes from the first line; dim.txt only gives param_count, which
+    # does not apply to b.txt or weight files.
+    
+    with open(mat_file, "r") as matf:
+        first_cols = len(matf.readline().split())
+    
+    if ncols is not None and ncols != first_cols and ncols != 1:
+        sys.stderr.write("Warning: " + mat_file + " has " + str(first_cols) + " columns, expected " + str(ncols) + "\n")
+    ncols = first_cols
+    
+    if nrows is None:
+        nrows = count_matrix_dims(mat_file)[0]
+        
+    mat = numpy.empty((nrows, ncols), dtype=float)
+    
+    for (row, chunk) in iter_text_chunks(mat_file, nrows, ncols, chunk_values):
+        mat[row:row+chunk.shape[0]] = chunk
+            
+    if ncols == 1:
+        mat = mat.reshape(nrows)
+    
+    if cache:
+        try:
+            numpy.save(sidecar + ".tmp.npy", mat)
+            os.replace(sidecar + ".tmp.npy", sidecar)
+            with open(keyfile, "w") as keyf:
+                keyf.write(binary_cache_key(mat_file) + "\n")
+        except OSError:
+            remove_partial_file(sidecar + ".tmp.npy")
+            sys.stderr.write("Warning: could not write binary cache " + sidecar + "; continuing without it\n")
+    
+    return mat
+
+
+def iter_text_chunks(mat_file, nrows, ncols, chunk_values=1 << 21, first_row=0):
+## Generator over a text matrix with nrows rows and ncols columns, yielding (first row, chunk)
+## pairs where chunk holds about chunk_values numbers.  Raises MatrixFileError if the file 
+## does not hold exactly nrows rows of ncols columns.  Rows before first_row are skipped 
+## without being parsed.
+
+    chunk_rows = chunk_values // ncols
+    
+    if chunk_rows < 1:
+        chunk_rows = 1
+    row        = first_row
+    
+    with open(mat_file, "r") as matf:
+        for skip in range(first_row):
+            matf.readline()
+            
+        while row < nrows:
+            try:
+                chunk = numpy.loadtxt(matf, dtype=float, ndmin=2, max_rows=numpy.minimum(chunk_rows, nrows - row))
+            except ValueError:
+                raise MatrixFileError("inconsistent number of columns in " + mat_file)
+            if chunk.shape[0] == 0:
+                break
+            if chunk.shape[1] != ncols:
+                raise MatrixFileError("inconsistent number of columns in " + mat_file)
+            yield row, chunk
+            row += chunk.shape[0]
+            
+        if row != nrows or matf.readline().strip() != "":
+            raise MatrixFileError(mat_file + " does not have the expected " + str(nrows) + " rows")
+
+
+def iter_matrix_chunks(mat_file, nrows, ncols, chunk_values=1 << 21, first_row=0):
+## As iter_text_chunks, but mat_file may also be a binary container, whose rows are 
+## served as slices of the memory map.  An up-to-date .npy sidecar written by load_matrix
+## is memory-mapped in place of the text file.
+
+    if is_binary_matrix(mat_file):
+        A = open_binary_matrix(mat_file)[0]
+    elif valid_binary_cache(mat_file):
+        A = numpy.load(mat_file + ".npy", mmap_mode='r')
+    else:
+        for item in iter_text_chunks(mat_file, nrows, ncols, chunk_values, first_row):
+            yield item
+        return
+    
+    if A.shape != (nrows, ncols):
+        raise MatrixFileError(mat_file + " does not have the expected shape " + str((nrows, ncols)))
+    
+    chunk_rows = chunk_values // ncols
+    
+    if chunk_rows < 1:
+        chunk_rows = 1
+        
+    for row in range(first_row, nrows, chunk_rows):
+        yield row, A[row:row+chunk_rows]
+
+
+def load_sparse_matrix(split_files, cache=False, chunk_values=1 << 21):
+## Read the A files listed in split_files, as (A file, first row, number of rows, param_count)
+## tuples, into one scipy.sparse CSR matrix.  Each chunk of about chunk_values numbers is
+## converted as it is parsed, so only the nonzeros of A are held.  With cache=True, a 
+## <A file>.csr.npz sidecar keyed on the size and mtime of the A file is written after 
+## parsing, and read instead of the A file on later calls.
+
+    blocks = []
+    
+    for (A_file, start, nrows, ncols) in split_files:
+    
+        sidecar = A_file + ".csr.npz"
+        keyfile = sidecar + ".key"
+        block   = None
+        
+        if cache and os.path.exists(sidecar) and os.path.exists(keyfile):
+            with open(keyfile, "r") as keyf:
+                if keyf.read().strip() == binary_cache_key(A_file):
+                    block = scipy.sparse.load_npz(sidecar).tocsr()
+                    
+        if block is None:
+        
+            block = scipy.sparse.vstack([scipy.sparse.csr_matrix(chunk) for (row, chunk) in iter_matrix_chunks(A_file, nrows, ncols, chunk_values)], 
+                                        format="csr")
+                                        
+            if cache:
+                try:
+                    scipy.sparse.save_npz(sidecar + ".tmp.npz", block)
+                    os.replace(sidecar + ".tmp.npz", sidecar)
+                    with open(keyfile, "w") as keyf:
+                        keyf.write(binary_cache_key(A_file) + "\n")
+                except OSError:
+                    remove_partial_file(sidecar + ".tmp.npz")
+                    sys.stderr.write("Warning: could not write binary cache " + sidecar + "; continuing without it\n")
+                    
+        if block.shape != (nrows, ncols):
+            sys.stderr.write("Error: " + A_file + " does not have the expected shape " + str((nrows, ncols)) + "\n")
+            exit(1)
+            
+        blocks.append(block)
+        
+    return scipy.sparse.vstack(blocks, format="csr")
+
+
+# Binary A/b container: a 64 byte header followed by raw little-endian float64 blocks
+# holding A (nrows x param_count, row major) and then b (nrows).  The header stores the
+# same param_count, start, end and total fields as dim.txt / dim.%04d.txt, plus the 
+# number of rows held in this file.
+
+BIN_MAGIC       = b"CHMSLSQA"
+BIN_VERSION     = 1
+BIN_HEADER_SIZE = 64
+
+
+def is_binary_matrix(mat_file):
+## True if mat_file is a binary A/b container written by write_binary_matrix.
+    if not os.path.isfile(mat_file):
+        return False
+    with open(mat_file, "rb") as matf:
+        return matf.read(len(BIN_MAGIC)) == BIN_MAGIC
+
+
+def write_binary_matrix(bin_file, A, b, start=0, total=None):
+## Write A and b to a binary container.  start and total describe where these rows sit 
+## in the full A matrix, as in dim.%04d.txt; by default the file holds the whole matrix.
+
+    nrows = A.shape[0]
+    
+    if total is None:
+        total = start + nrows
+    
+    header = numpy.array([BIN_VERSION, A.shape[1], start, start + nrows - 1, total, nrows], dtype='<i8')
+    
+    with open(bin_file + ".tmp", "wb") as binf:
+        binf.write(BIN_MAGIC)
+        binf.write(header.tobytes())
+        binf.write(bytes(BIN_HEADER_SIZE - len(BIN_MAGIC) - header.nbytes))
+        numpy.ascontiguousarray(A, dtype='<f8').tofile(binf)
+        numpy.ascontiguousarray(b, dtype='<f8').tofile(binf)
+    
+    os.replace(bin_file + ".tmp", bin_file)
+
+
+def open_binary_matrix(bin_file, mode='r'):
+## Memory-map a binary container.  Returns A, b and the dim list [param_count, start, end, total].
+
+    with open(bin_file, "rb") as binf:
+        if binf.read(len(BIN_MAGIC)) != BIN_MAGIC:
+            sys.stderr.write("Error: " + bin_file + " is not a binary A/b container\n")
+            exit(1)
+        header = numpy.frombuffer(binf.read(6 * 8), dtype='<i8')
+    
+    (version, param_count, start, end, total, nrows) = (int(v) for v in header)
+    
+    if version != BIN_VERSION:
+        sys.stderr.write("Error: unsupported binary container version " + str(version) + " in " + bin_file + "\n")
+        exit(1)
+    
+    A = numpy.memmap(bin_file, dtype='<f8', mode=mode, offset=BIN_HEADER_SIZE, shape=(nrows, param_count))
+    b = numpy.memmap(bin_file, dtype='<f8', mode=mode, offset=BIN_HEADER_SIZE + 8 * nrows * param_count, shape=(nrows,))
+    
+    return A, b, [param_count, start, end, total]
+
+
+#############################################
+#############################################
+# Parameter file layout
+#############################################
+#############################################
+
+# The parameter file written by main is the params.header text up to the triplet and 
+# quadruplet counts, followed by one line per parameter, the ff_groups.map contents and 
+# any energy offsets.  parse_header_layout reads params.header once and returns a layout
+# dict: the parameter file text as a format string with a %21.13e field per parameter 
+# ("template"), the index into x of each field ("slots"), and the x index ranges of each 
+# interaction (see below).  load_header_layout caches the layout in a <header>.layout.npz
+# sidecar keyed on the SHA-1 of the header.
+#
+# x is ordered as: SNUM_2B coefficients for each pair, the unique triplet coefficients of 
+# each (non-excluded) triplet type, the unique quadruplet coefficients of each quadruplet 
+# type, one Coulomb charge product per pair (if FITCOUL), then optionally one energy offset
+# per atom type.
+
+LAYOUT_VERSION = 2
+
+PARAM_PAIR    = 0
+PARAM_TRIPLET = 1
+PARAM_QUAD    = 2
+PARAM_COUL    = 3
+PARAM_ENERGY  = 4
+
+LINE_TEXT    = 0
+LINE_PAIRS   = 1
+LINE_HEADING = 2
+LINE_ROW     = 3
+
+
+def parse_header_layout(header_file):
+## Build the parameter file layout of header_file (see above).
+
+    with open(header_file, "r") as hf:
+        hf = hf.readlines()
+        
+    lines      = []     # Lines of the template, with %21.13e fields
+    line_slot  = []     # x index of the field on each line, or -1
+    line_block = []     # Cluster type (block) number of each line, or -1
+    line_role  = []     # LINE_TEXT, LINE_PAIRS (cluster "PAIRS:" line), LINE_HEADING or LINE_ROW
+    
+    def text(line):
+        return line.replace("%", "%%")
+        
+    def add(line, slot=-1, block=-1, role=LINE_TEXT):
+        lines.append(line)
+        line_slot.append(slot)
+        line_block.append(block)
+        line_role.append(role)
+    
+    # Echo the header up to the triplet (and quadruplet) counts, and find EXCL_2B
+    
+    EXCL_2B         = []
+    ATOM_TRIPS_LINE = 0
+    ATOM_QUADS_LINE = 0
+    TOTAL_TRIPS     = 0
+    TOTAL_QUADS     = 0
+    BREAK_COND      = False
+
+    for i in range(0, len(hf)):
+        add(text(hf[i].rstrip('\n')))
+        TEMP = hf[i].split()
+        
+        if "EXCL_2B" in hf[i]:
+            EXCL_2B = TEMP[1:]
+
+        if len(TEMP) > 3 and TEMP[2] == "TRIPLETS:":
+            TOTAL_TRIPS     = int(TEMP[3])
+            ATOM_TRIPS_LINE = i
+
+            for j in range(i, len(hf)):
+                TEMP = hf[j].split()
+                if len(TEMP) > 3 and TEMP[2] == "QUADRUPLETS:":
+                    add(text(hf[j].rstrip('\n')))
+                    TOTAL_QUADS     = int(TEMP[3])
+                    ATOM_QUADS_LINE = j
+                    BREAK_COND      = True
+                    break
+                    
+        if BREAK_COND:
+            break
+
+    POTENTIAL = hf[5].split()[1]
+    SNUM_2B   = 0
+
+    if POTENTIAL == "CHEBYSHEV" and len(hf[5].split()) >= 4:
+        SNUM_2B = int(hf[5].split()[2])
+        
+    FIT_COUL         = hf[1].split()[1]
+    ATOM_TYPES_LINE  = 7
+    TOTAL_ATOM_TYPES = int(hf[ATOM_TYPES_LINE].split()[2])
+    ATOM_PAIRS_LINE  = ATOM_TYPES_LINE+2+TOTAL_ATOM_TYPES+2
+    TOTAL_PAIRS      = int(hf[ATOM_PAIRS_LINE].split()[2]) - len(EXCL_2B)
+    ATOM_TYPES       = [hf[ATOM_TYPES_LINE+3+i].split()[1] for i in range(TOTAL_ATOM_TYPES)]
+    
+    # Each triplet type block: a header line, a "PAIRS:" line with the unique and total 
+    # counts (or EXCLUDED:), two table heading lines, the powers table and a blank line.
+    # Quadruplet blocks are laid out the same way, with six pairs per "PAIRS:" line.
+    
+    trip_blocks = []    # (index line, PAIRS: fields, table lines or None if excluded)
+    ADD_LINES   = 0
+    
+    for t in range(TOTAL_TRIPS):
+    
+        P1 = hf[ATOM_TRIPS_LINE+3+ADD_LINES].split()
+        
+        if P1[4] == "EXCLUDED:":
+            trip_blocks.append((hf[ATOM_TRIPS_LINE+2+ADD_LINES], P1, None))
+            ADD_LINES += 1
+        else:
+            table = hf[ATOM_TRIPS_LINE+6+ADD_LINES : ATOM_TRIPS_LINE+6+ADD_LINES+int(P1[6])]
+            trip_blocks.append((hf[ATOM_TRIPS_LINE+2+ADD_LINES], P1, table))
+            ADD_LINES += 3 + int(P1[6])
+            
+        ADD_LINES += 2
+            
+    quad_blocks = []
+    ADD_LINES   = 0
+    
+    for t in range(TOTAL_QUADS):
+    
+        P1 = hf[ATOM_QUADS_LINE+3+ADD_LINES].split()
+        
+        if P1[7] == "EXCLUDED:":
+            quad_blocks.append((hf[ATOM_QUADS_LINE+2+ADD_LINES], P1, None))
+            ADD_LINES += 1
+        else:
+            table = hf[ATOM_QUADS_LINE+6+ADD_LINES : ATOM_QUADS_LINE+6+ADD_LINES+int(P1[9])]
+            quad_blocks.append((hf[ATOM_QUADS_LINE+2+ADD_LINES], P1, table))
+            ADD_LINES += 3 + int(P1[9])
+            
+        ADD_LINES += 2
+        
+    SNUM_3B = numpy.sum([int(P1[4]) for (index, P1, table) in trip_blocks if table is not None], dtype=int)
+    SNUM_4B = numpy.sum([int(P1[7]) for (index, P1, table) in quad_blocks if table is not None], dtype=int)
+    
+    TRIP_START = TOTAL_PAIRS * SNUM_2B
+    QUAD_START = TRIP_START + SNUM_3B
+    COUL_START = QUAD_START + SNUM_4B
+    
+    # Pairs and charges
+
+    add("")
+    add("PAIR " + POTENTIAL + " PARAMS \n")
+    
+    pair_types   = []
+    pair_ranges  = numpy.zeros((TOTAL_PAIRS, 2), dtype=int)
+    
+    for i in range(0, TOTAL_PAIRS):
+
+        A1 = hf[ATOM_PAIRS_LINE+2+i+1].split()
+        pair_types.append((A1[1], A1[2]))
+        
+        pair_ranges[i] = (i*SNUM_2B, (i+1)*SNUM_2B)
+        
+        add(text("PAIRTYPE PARAMS: " + str(i) + " " + A1[1] + " " + A1[2] + "\n"))
+
+        for j in range(0, SNUM_2B):
+            add("%3d %%21.13e" % j, i*SNUM_2B+j)
+
+        if FIT_COUL == "true":
+            add(text("q_%s x q_%s " % (A1[1], A1[2])) + "%21.13e", COUL_START + i)
+
+        add(" ")
+        
+    COUNTED_COUL_PARAMS = TOTAL_PAIRS if FIT_COUL == "true" else 0
+    
+    # Triplets and quadruplets
+    
+    trip_ranges = numpy.zeros((TOTAL_TRIPS, 2), dtype=int)
+    quad_ranges = numpy.zeros((TOTAL_QUADS, 2), dtype=int)
+    block_pairs = []    # "PAIRS:" atom pair names of each cluster type, triplets first
+    
+    for (title, blocks, ranges, start, npairs, uniq_col, idx_col) in (("TRIPLET",    trip_blocks, trip_ranges, TRIP_START, 3, 4, 5),
+                                                                     ("QUADRUPLET", quad_blocks, quad_ranges, QUAD_START, 6, 7, 8)):
+        if len(blocks) == 0:
+            continue
+            
+        add(title + " " + POTENTIAL + " PARAMS \n")
+        
+        PAR_IDX = start
+        
+        for t in range(len(blocks)):
+        
+            (index, P1, table) = blocks[t]
+            
+            add(("TRIPLETTYPE PARAMS:" if title == "TRIPLET" else "QUADRUPLETYPE PARAMS: "))
+            add(text("  " + index.rstrip()))
+            
+            PAIRS = " ".join(P1[1:1+npairs])
+            BLOCK = len(block_pairs)
+            
+            block_pairs.append(PAIRS)
+            
+            if table is None:
+                add(text("   PAIRS: " + PAIRS + (" EXCLUDED:" if title == "TRIPLET" else " EXCLUDED: ")), -1, BLOCK, LINE_PAIRS)
+                ranges[t] = (PAR_IDX, PAR_IDX)
+            else:
+                UNIQ = int(P1[uniq_col])
+                
+                add(text("   PAIRS: " + PAIRS + " UNIQUE: " + P1[uniq_col] + " TOTAL: " + P1[uniq_col+2].rstrip()), -1, BLOCK, LINE_PAIRS)
+                add("     index  |  powers  |  equiv index  |  param index  |       parameter       ", -1, BLOCK, LINE_HEADING)
+                add("   ----------------------------------------------------------------------------", -1, BLOCK, LINE_HEADING)
+                
+                for LINE in table:
+                    add(text(LINE.rstrip('\n')) + " %21.13e", PAR_IDX + int(LINE.split()[idx_col]), BLOCK, LINE_ROW)
+                    
+                ranges[t] = (PAR_IDX, PAR_IDX + UNIQ)
+                PAR_IDX  += UNIQ
+                
+            add("")
+            
+    add("")
+    
+    line_slot = numpy.array(line_slot, dtype=int)
+    
+    param_kind = numpy.zeros(COUL_START + COUNTED_COUL_PARAMS, dtype=int)
+    
+    param_kind[TRIP_START:QUAD_START] = PARAM_TRIPLET
+    param_kind[QUAD_START:COUL_START] = PARAM_QUAD
+    param_kind[COUL_START:]           = PARAM_COUL
+
+    return {"version"      : LAYOUT_VERSION,
+            "template"     : "\n".join(lines) + "\n",
+            "slots"        : line_slot[line_slot >= 0],
+            "lines"        : lines,
+            "line_slot"    : line_slot,
+            "line_block"   : numpy.array(line_block, dtype=int),
+            "line_role"    : numpy.array(line_role,  dtype=int),
+            "block_pairs"  : block_pairs,
+            "potential"    : POTENTIAL,
+            "atom_types"   : ATOM_TYPES,
+            "pair_types"   : pair_types,
+            "snum_2b"      : SNUM_2B,
+            "pair_ranges"  : pair_ranges,
+            "trip_ranges"  : trip_ranges,
+            "quad_ranges"  : quad_ranges,
+            "coul_start"   : COUL_START,
+            "n_coul"       : COUNTED_COUL_PARAMS,
+            "n_trip"       : SNUM_3B,
+            "n_quad"       : SNUM_4B,
+            "total_params" : COUL_START + COUNTED_COUL_PARAMS,
+            "n_energy"     : TOTAL_ATOM_TYPES,
+            "param_kind"   : param_kind}
+    
+
+def load_header_layout(header_file, cache=False):
+## parse_header_layout, with the result cached in <header_file>.layout.npz.  The cache is 
+## used when its stored SHA-1 matches the current contents of header_file.
+
+    with open(header_file, "rb") as hf:
+        key = hashlib.sha1(hf.read()).hexdigest()
+        
+    cache_file = header_file + ".layout.npz"
+    
+    if cache and os.path.exists(cache_file):
+        try:
+            with numpy.load(cache_file) as saved:
+                if str(saved["key"]) == key and int(saved["version"]) == LAYOUT_VERSION:
+                    layout = {}
+                    for name in saved.files:
+                        layout[name] = saved[name][()] if saved[name].ndim == 0 else saved[name]
+                    layout["atom_types"]  = list(layout["atom_types"])
+                    layout["lines"]       = list(layout["lines"])
+                    layout["block_pairs"] = list(layout["block_pairs"])
+                    layout["pair_types"] = [tuple(pair) for pair in layout["pair_types"]]
+                    return layout
+        except (OSError, ValueError, KeyError):
+            pass
+            
+    layout = parse_header_layout(header_file)
+    
+    if cache:
+        try:
+            numpy.savez(cache_file + ".tmp.npz", key=key, **layout)
+            os.replace(cache_file + ".tmp.npz", cache_file)
+        except OSError:
+            remove_partial_file(cache_file + ".tmp.npz")
+            sys.stderr.write("Warning: could not write header layout cache " + cache_file + "; continuing without it\n")
+            
+    return layout
+
+
+def format_params(layout, x, map_lines):
+## The parameter file for solution x as one string: the layout template filled with x, 
+## the ff_groups.map lines, and energy offsets if x holds one per atom type.
+
+    total_params = int(layout["total_params"])
+    n_energy     = int(layout["n_energy"])
+    
+    # Parameter count could be off by natom_types, if energies are included in the fit
+    
+    if (total_params != len(x)) and (len(x) != (total_params+n_energy)) :
+        sys.stderr.write( "Error in counting parameters\n") 
+        sys.stderr.write("len(x) " + str(len(x)) + "\n") 
+        sys.stderr.write("TOTAL_PAIRS " + str(len(layout["pair_ranges"])) + "\n") 
+        sys.stderr.write("SNUM_2B " + str(layout["snum_2b"]) + "\n") 
+        sys.stderr.write("COUNTED_TRIP_PARAMS " + str(layout["n_trip"]) + "\n") 
+        sys.stderr.write("COUNTED_QUAD_PARAMS " + str(layout["n_quad"]) + "\n")
+        sys.stderr.write("COUNTED_COUL_PARAMS " + str(layout["n_coul"]) + "\n")
+        exit(1)
+        
+    out = [str(layout["template"]) % tuple(numpy.asarray(x)[layout["slots"]])]
+    
+    out.append("".join([line.rstrip('\n') + "\n" for line in map_lines]))
+    out.append("\n")
+    
+    if len(x) == total_params + n_energy:
+        out.append("NO ENERGY OFFSETS:  " + str(n_energy) + "\n")
+        out.append("".join(["ENERGY OFFSET %d %21.13e\n" % (i+1, x[total_params+i]) for i in range(n_energy)]))
+        
+    out.append("ENDFILE\n")
+    
+    return "".join(out)
+
+
+def read_solution(solution_file, layout, nvars):
+## Read a solution vector x of length nvars from a parameter file written by chimes_lsq for
+## the header of layout (not a reduced file), or from a text file of values, one per line 
+## (x.txt), optionally preceded by an index column (test_suite_params.txt).
+
+    with open(solution_file, "r") as solf:
+        lines = [line.rstrip('\n') for line in solf if not line.startswith("!")]
+        
+    if "ENDFILE" not in [line.strip() for line in lines]:
+    
+        x = numpy.loadtxt(lines, ndmin=2)[:,-1]
+        
+    else:
+    
+        # Layout lines may span several file lines (e.g. block headings)
+        
+        x     = numpy.zeros(nvars)
+        slot  = layout["line_slot"]
+        rows  = numpy.flatnonzero(slot >= 0)
+        start = numpy.arange(len(slot)) + numpy.cumsum([0] + [line.count('\n') for line in layout["lines"][:-1]])
+        
+        if len(lines) < start[-1] + 1:
+            sys.stderr.write("Error: " + solution_file + " does not match the parameter layout of the header\n")
+            exit(1)
+            
+        try:
+            x[slot[rows]] = [float(lines[i].split()[-1]) for i in start[rows]]
+        except (ValueError, IndexError):
+            sys.stderr.write("Error: " + solution_file + " does not match the parameter layout of the header (reduced parameter files can not be read)\n")
+            exit(1)
+            
+        offsets = [line.split() for line in lines if line.startswith("ENERGY OFFSET")]
+        
+        for fields in offsets:
+            if int(layout["total_params"]) + int(fields[2]) - 1 < nvars:
+                x[int(layout["total_params"]) + int(fields[2]) - 1] = float(fields[3])
+                
+    if len(x) != nvars:
+        sys.stderr.write("Error: " + solution_file + " holds " + str(len(x)) + " parameters, expected " + str(nvars) + "\n")
+        exit(1)
+        
+    return x
+
+
+def prune_layout(layout, x, tol=1.0e-06):
+## Remove parameters with |x| < tol.  Small pair coefficients are set to zero (every pair 
+## type keeps SNUM_2B coefficient lines); small triplet and quadruplet coefficients are 
+## dropped from their cluster type, which is renumbered and written with UNIQUE: -1 in the 
+## format of post_proc_chimes_lsq.py, or written as EXCLUDED when no coefficient remains.  Coulomb 
+## products and energy offsets are kept.  Returns the reduced layout and x, and the 
+## numbers of zeroed pair coefficients, kept cluster coefficients and removed cluster 
+## coefficients.
+
+    x     = numpy.array(x, dtype=float)
+    kind  = layout["param_kind"]
+    small = numpy.abs(x[:len(kind)]) < tol
+    
+    zeroed    = small & (kind == PARAM_PAIR)
+    x[:len(kind)][zeroed] = 0.0
+    
+    slot  = layout["line_slot"]
+    block = layout["line_block"]
+    role  = layout["line_role"]
+    
+    drop = (role == LINE_ROW) & small[numpy.maximum(slot, 0)]
+    
+    # Per cluster type counts, with a last, empty entry for lines outside cluster types (block -1)
+    
+    nblocks   = len(layout["block_pairs"])
+    rows_kept = numpy.bincount(block[(role == LINE_ROW) & ~drop], minlength=nblocks+1)
+    had_rows  = numpy.bincount(block[role == LINE_ROW], minlength=nblocks+1) > 0
+    
+    # Headings of cluster types left without coefficients go too
+    
+    drop |= (role == LINE_HEADING) & had_rows[block] & (rows_kept[block] == 0)
+    
+    lines = list(layout["lines"])
+    quad  = lambda b: len(layout["block_pairs"][b].split()) == 6
+    
+    for i in numpy.flatnonzero((role == LINE_PAIRS) & had_rows[block]):
+        b = block[i]
+        if rows_kept[b] == 0:
+            lines[i] = "   PAIRS: " + layout["block_pairs"][b] + (" EXCLUDED: " if quad(b) else " EXCLUDED:")
+        else:
+            lines[i] = " ".join(["PAIRS:", layout["block_pairs"][b], "UNIQUE:", "-1", "TOTAL:", str(rows_kept[b])])
+            
+    # Renumber the remaining rows of each cluster type
+    
+    rows   = numpy.flatnonzero((role == LINE_ROW) & ~drop)
+    starts = numpy.concatenate(([0], numpy.cumsum(rows_kept)))
+    index  = numpy.arange(len(rows)) - starts[block[rows]]
+    
+    for (i, k) in zip(rows, index):
+        fields     = lines[i].split()
+        fields[0]  = str(k)
+        fields[-1] = "%.13e"
+        lines[i]   = " ".join(fields)
+        
+    keep    = numpy.flatnonzero(~drop)
+    reduced = dict(layout)
+    
+    reduced["lines"]      = [lines[i] for i in keep]
+    reduced["line_slot"]  = slot[keep]
+    reduced["line_block"] = block[keep]
+    reduced["line_role"]  = role[keep]
+    reduced["slots"]      = slot[keep][slot[keep] >= 0]
+    reduced["template"]   = "\n".join(reduced["lines"]) + "\n"
+    
+    nremoved = int(numpy.count_nonzero(drop & (role == LINE_ROW)))
+    
+    return reduced, x, int(numpy.count_nonzero(zeroed)), len(rows), nremoved
+
+
+#############################################
+#############################################
+# DLARS wrapper
+#############################################
+#############################################
+
+def mpi_launcher(mpistyle, nodes, cores, offset=None):
+## Command prefix that starts an MPI job of cores ranks on nodes nodes.  For ibrun, which 
+## otherwise uses the whole allocation, offset selects the first task of a sub-allocation.
+
+    if mpistyle == "srun": 
+        return ["srun", "-N", str(nodes), "-n", str(cores)]
+    elif mpistyle == "ibrun" and offset is not None:
+        return ["ibrun", "-n", str(cores), "-o", str(offset)]
+    elif mpistyle == "ibrun":
+        return ["ibrun"]
+    elif mpistyle == "mpirun" or mpistyle == "mpiexec":
+        return [mpistyle, "-n", str(cores)]
+    elif mpistyle == "local":
+        return []
+        
+    print("Unrecognized mpistyle:",mpistyle,". Recognized options are srun, ibrun, mpirun, mpiexec or local")
+    sys.exit(1)
+    
+    
+def dlars_command(dlars_file, launcher, A, b, alpha, split_files, algorithm, weights, normalize, restart_dlasso_dlars, dim_file="dim.txt"):
+## Argument list of a DLARS/DLASSO run.  With split files, DLARS reads A.%04d.txt and 
+## dim.%04d.txt next to the given A and dim files.
+
+    command = launcher + [dlars_file, A, b, dim_file, "--lambda=" + str(alpha)]
+
+    if ( split_files ) :
+        command.append("--split_files")
+    if ( algorithm == 'dlars' ):
+        command.append("--algorithm=lars")
+    elif ( algorithm == 'dlasso' ):
+        command.append("--algorithm=lasso")
+
+    if ( weights != 'None' ):
+        command.append("--weights=" + weights)
+
+    if ( normalize ):
+        command.append("--normalize=y")
+    else:
+        command.append("--normalize=n")
+
+    if restart_dlasso_dlars != "":
+        command.append("--restart=" + restart_dlasso_dlars)
+        
+    return command
+    
+
+def parse_dlars_line(line, progress):
+## Update the progress of a DLARS/DLASSO run from one line of its log.
+
+    fields = line.split()
+    
+    try:
+        if line.startswith("L1 norm of solution:") and len(fields) == 15:
+        
+            # L1 norm of solution: <l1> RMS Error: <rms> Objective fn: <obj> Number of vars: <n>
+            
+            progress["l1norm"]    = float(fields[4])
+            progress["rms"]       = float(fields[7])
+            progress["objective"] = float(fields[10])
+            progress["nvars"]     = int(fields[14])
+            
+        elif line.startswith("Finished iteration"):
+            progress["iteration"] = int(fields[2])
+            
+        elif line.startswith("Stopping:"):
+            progress["status"] = line.strip()
+            
+    except (ValueError, IndexError):
+        pass
+        
+        
+def dlars_progress_line(progress):
+## One line summary of a DLARS/DLASSO run.
+
+    return ("DLARS %s: iteration %d, active set %d, RMS error %.4e, objective fn %.6e, %.0f s" 
+            % (progress["name"], progress["iteration"], progress["nvars"], progress["rms"], progress["objective"], progress["elapsed"]))
+            
+            
+def dlars_log_reader(proc, job, progress):
+## Copy the output of a DLARS/DLASSO run to its log file, parsing progress on the way.  Every
+## job["checkpoint"] minutes, the restart files of the last finished iteration are copied.
+
+    last = datetime.now().timestamp()
+    
+    with open(os.path.join(job["cwd"], job["log"]), "a" if job.get("append", False) else "w") as logf:
+        for line in proc.stdout:
+            logf.write(line)
+            logf.flush()
+            parse_dlars_line(line, progress)
+            
+            # Restart files are complete once their iteration has finished
+            
+            if line.startswith("Finished iteration") and job.get("checkpoint", 0.0) > 0:
+                if datetime.now().timestamp() - last >= 60.0 * job["checkpoint"]:
+                    if dlars_checkpoint(job["cwd"]) > 0:
+                        last = datetime.now().timestamp()
+            
+
+def run_dlars_jobs(jobs, walltime, interval):
+## Run DLARS/DLASSO jobs (dicts of name, command, cwd and log file) at the same time, 
+## streaming each log into its progress dict, and stop any job still running after
+## walltime minutes.  Progress lines are written to stderr every interval seconds.
+## Returns the progress of each job, including its return code and timeout status.
+
+    start    = datetime.now().timestamp()
+    progress = []
+    procs    = []
+    readers  = []
+    finished = threading.Event()        # Set when the log of a job ends, i.e. the job is exiting
+    
+    def read_log(proc, job, prog):
+        try:
+            dlars_log_reader(proc, job, prog)
+        finally:
+            finished.set()
+    
+    for job in jobs:
+    
+        prog = { "name" : job["name"], "iteration" : 0, "nvars" : 0, "l1norm" : 0.0, "rms" : float("nan"), 
+                 "objective" : float("nan"), "status" : "", "elapsed" : 0.0, "timed_out" : False, "returncode" : None }
+                 
+        try:
+            proc = subprocess.Popen(job["command"], cwd=job["cwd"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, 
+                                    universal_newlines=True, bufsize=1, start_new_session=True)
+        except OSError as err:
+            print(" ".join(job["command"]) + " failed: " + str(err))
+            sys.exit(1)
+            
+        reader = threading.Thread(target=read_log, args=(proc, job, prog))
+        reader.daemon = True
+        reader.start()
+        
+        progress.append(prog)
+        procs.append(proc)
+        readers.append(reader)
+        
+    # Runs are in their own sessions: pass on a termination (e.g. preemption) of this process
+    
+    def stop_jobs(signum, frame):
+        for proc in procs:
+            if proc.poll() is None:
+                os.killpg(proc.pid, signal.SIGTERM)
+        sys.exit(1)
+        
+    previous = signal.signal(signal.SIGTERM, stop_jobs)
+    last     = start
+    
+    while len([proc for proc in procs if proc.poll() is None]) > 0:
+    
+        # Sleep until a job's log ends, the wall time limit or the next progress lines
+        
+        waits = []
+        now   = datetime.now().timestamp()
+        
+        if walltime > 0 and len([prog for (proc, prog) in zip(procs, progress) if proc.poll() is None and not prog["timed_out"]]) > 0:
+            waits.append(numpy.maximum(start + 60.0 * walltime - now, 0.0))
+        if interval > 0:
+            waits.append(numpy.maximum(last + interval - now, 0.0))
+        if len([proc for (proc, reader) in zip(procs, readers) if proc.poll() is None and not reader.is_alive()]) > 0:
+            waits.append(0.1)           # Log closed, process still exiting
+            
+        finished.wait(timeout=min(waits) if len(waits) > 0 else None)
+        finished.clear()
+            
+        now = datetime.now().timestamp()
+        
+        for proc, prog in zip(procs, progress):
+        
+            if proc.poll() is not None:
+                continue
+                
+            prog["elapsed"] = now - start
+            
+            if walltime > 0 and now - start > 60.0 * walltime and not prog["timed_out"]:
+            
+                # Stop the launcher and its ranks; a restart file is left for the last finished iteration
+                
+                prog["timed_out"] = True
+                os.killpg(proc.pid, signal.SIGTERM)
+                
+        if interval > 0 and now - last >= interval:
+            for prog in progress:
+                sys.stderr.write(dlars_progress_line(prog) + "\n")
+            sys.stderr.flush()
+            last = now
+            
+    for proc, prog, reader in zip(procs, progress, readers):
+    
+        reader.join()
+        proc.stdout.close()
+        
+        prog["returncode"] = proc.wait()
+        prog["elapsed"]    = datetime.now().timestamp() - start
+        
+    signal.signal(signal.SIGTERM, previous)
+    
+    return progress
+    
+
+def scan_dlars(dlasso_dlars_path, nodes, cores, alphas, njobs, split_files, algorithm, read_output, weights, normalize, A, b, mpistyle, walltime, interval):
+## Run DLARS/DLASSO for each alpha in its own directory, dlars_scan/alpha_<alpha>, with njobs
+## runs at a time, each on an equal share of the nodes and cores.  Returns the alphas of the
+## runs that finished, their directories, solutions X and predictions Y (from Ax.txt), one 
+## column per alpha.
+
+    if algorithm == 'dlasso' :
+        print ('! DLARS code for LASSO used')
+    else:
+        print ('! DLARS code for LARS used')
+        
+    dirs = [os.path.join("dlars_scan", "alpha_%.4e" % alpha) for alpha in alphas]
+    done = numpy.ones(len(alphas), dtype=bool)
+    
+    if not read_output:
+    
+        dlars_file = os.path.abspath(dlasso_dlars_path + "dlars")
+        
+        if not os.path.exists(dlars_file):
+            print (dlars_file + " does not exist")
+            sys.exit(1)
+            
+        if njobs <= 0:
+            njobs = nodes if nodes > 1 else len(alphas)
+            
+        # DLARS needs at least one rank per split A file
+        
+        min_cores = len(split_matrix_files(os.path.dirname(os.path.abspath(A)))) if split_files else 1
+        njobs     = int(numpy.clip(numpy.amin([njobs, len(alphas), cores // min_cores]), 1, None))
+        job_nodes = int(numpy.clip(nodes // njobs, 1, None))
+        job_cores = int(numpy.clip(cores // njobs, 1, None))
+        
+        print ("! DLARS alpha scan: %d values, %d concurrent runs of %d cores on %d node(s)" % (len(alphas), njobs, job_cores, job_nodes))
+        
+        # Input files are given by absolute path, since each run has its own working directory
+        
+        if weights != 'None':
+            weights = os.path.abspath(weights)
+            
+        jobs = []
+        
+        for i in range(len(alphas)):
+        
+            if not os.path.isdir(dirs[i]):
+                os.makedirs(dirs[i])
+                
+            launcher = mpi_launcher(mpistyle, job_nodes, job_cores, (i % njobs) * job_cores)
+            command  = dlars_command(dlars_file, launcher, os.path.abspath(A), os.path.abspath(b), alphas[i], split_files, algorithm, 
+                                     weights, normalize, "", os.path.abspath("dim.txt"))
+                                     
+            print ("! DLARS run: " + " ".join(command) + " >& " + os.path.join(dirs[i], "dlars.log"))
+            
+            jobs.append({ "name" : "alpha %.4e" % alphas[i], "command" : command, "cwd" : dirs[i], "log" : "dlars.log" })
+            
+        sys.stdout.flush()
+        
+        # Runs are started in groups of njobs, so that each group fills the allocation once
+        
+        for first in range(0, len(jobs), njobs):
+        
+            progress = run_dlars_jobs(jobs[first:first+njobs], walltime, interval)
+            
+            for i in range(len(progress)):
+                done[first+i] = progress[i]["returncode"] == 0 and not progress[i]["timed_out"]
+                
+    else:
+        print ("! Reading output from prior DLARS alpha scan")
+        
+    for i in range(len(alphas)):
+        if done[i] and not os.path.exists(os.path.join(dirs[i], "Ax.txt")):
+            done[i] = False
+        if not done[i]:
+            print ("! DLARS alpha = %10.4e did not finish (see %s)" % (alphas[i], os.path.join(dirs[i], "dlars.log")))
+            
+    if not numpy.any(done):
+        print ("No DLARS run of the alpha scan finished")
+        sys.exit(1)
+        
+    keep = numpy.flatnonzero(done)
+    X    = numpy.transpose([numpy.genfromtxt(os.path.join(dirs[i], "x.txt"),  dtype='float') for i in keep])
+    Y    = numpy.transpose([numpy.genfromtxt(os.path.join(dirs[i], "Ax.txt"), dtype='float') for i in keep])
+    
+    return alphas[keep], [dirs[i] for i in keep], X, Y
+    
+
+DLARS_STATE       = "dlars_run.json"      # Settings and status of the last DLARS run in a directory
+DLARS_CHECKPOINTS = "dlars_checkpoints"   # Copies of the DLARS restart files, iter_<iteration>
+DLARS_KEEP        = 2                     # Number of checkpoints kept
+
+# Section headings of a DLARS restart file (DLARS::print_restart), in order
+
+DLARS_RESTART_SECTIONS = ("Lambda:", "Distributed_solver:", "Gamma_use:", "C_max:", "A_A:", "use_precondition:", "do_lasso:", 
+                          "solve_con_grad:", "Beta:", "A", "Exclude", "Mu", "c", "a", "G_A_Inv_I", "G_A", "pre_con", "chol")
+
+
+def dlars_restart_files(path):
+## DLARS restart files in path: restart.txt for a serial run, or restart.%04d, one per rank.
+
+    files = sorted(glob.glob(os.path.join(path, "restart.[0-9][0-9][0-9][0-9]")))
+    
+    if len(files) == 0 and os.path.exists(os.path.join(path, "restart.txt")):
+        files = [os.path.join(path, "restart.txt")]
+        
+    return files
+    
+    
+def dlars_restart_iteration(files):
+## Iteration of a set of DLARS restart files, or -1 if any file is incomplete (e.g. the run was 
+## stopped while writing it) or the files are from different iterations.  A complete file holds
+## the G_A matrix, one line per active variable on a single rank, followed by its Cholesky factor 
+## or preconditioner when the solver uses one.
+
+    iters = []
+    
+    for name in files:
+    
+        sections = { "" : 0 }
+        values   = {}
+        header   = ""
+        last     = ""
+        
+        with open(name, "r") as rst:
+        
+            first = rst.readline().split()
+            
+            for line in rst:
+            
+                key = line.strip()
+                
+                if key in DLARS_RESTART_SECTIONS:
+                    header = key
+                    sections[header] = 0
+                else:
+                    sections[header] += 1
+                    if header not in values:
+                        values[header] = key
+                last = line
+                
+        if len(first) != 2 or first[0] != "Iteration" or "G_A" not in sections or not last.endswith("\n"):
+            return -1
+            
+        try:
+            nactive = int(values["A"].split()[1])
+        except (KeyError, IndexError, ValueError):
+            return -1
+            
+        if values.get("Distributed_solver:") == "0" and name == files[0] and sections["G_A"] != nactive:
+            return -1
+            
+        if values.get("solve_con_grad:") == "0":
+            tail = "chol"
+        elif values.get("use_precondition:") == "1":
+            tail = "pre_con"
+        else:
+            tail = "G_A"
+            
+        if sections.get(tail, -1) != sections["G_A"]:
+            return -1
+            
+        iters.append(int(first[1]))
+        
+    if len(iters) == 0 or len(set(iters)) != 1:
+        return -1
+        
+    return iters[0]
+    
+    
+def dlars_checkpoint(path):
+## Copy the current restart files in path to DLARS_CHECKPOINTS/iter_<iteration>, keeping the
+## newest DLARS_KEEP copies.  Returns the iteration, or -1 if the files were incomplete.
+
+    files = dlars_restart_files(path)
+    
+    if len(files) == 0:
+        return -1
+        
+    ckpts = os.path.join(path, DLARS_CHECKPOINTS)
+    tmp   = os.path.join(ckpts, "partial")
+    
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+        
+    os.makedirs(tmp)
+    
+    for name in files:
+        shutil.copy(name, tmp)
+        
+    # DLARS may have rewritten a file while it was copied
+    
+    iteration = dlars_restart_iteration(dlars_restart_files(tmp))
+    dest      = os.path.join(ckpts, "iter_%08d" % iteration)
+    
+    if iteration < 0 or os.path.isdir(dest):
+        shutil.rmtree(tmp)
+        return -1
+        
+    os.rename(tmp, dest)
+    
+    for old in sorted(glob.glob(os.path.join(ckpts, "iter_[0-9]*")))[:-DLARS_KEEP]:
+        shutil.rmtree(old)
+        
+    return iteration
+    
+    
+def dlars_resume_point(nranks):
+## Newest complete set of nranks restart files in the working directory or its checkpoints, as 
+## (iteration, --restart argument), or (-1, "") if there is none.  DLARS adds the rank suffix
+## to the --restart argument when run on more than one rank.  When the launcher chose the
+## number of ranks (nranks None), it is that of the largest set the unfinished run left.
+
+    best  = (-1, "")
+    paths = ["."] + sorted(glob.glob(os.path.join(DLARS_CHECKPOINTS, "iter_[0-9]*")))
+    
+    if nranks is None:
+        nranks = int(numpy.max([len(dlars_restart_files(path)) for path in paths]))
+    
+    for path in paths:
+    
+        files = dlars_restart_files(path)
+        
+        if len(files) == 0 or len(files) != nranks or (nranks == 1) != files[0].endswith("restart.txt"):
+            continue
+            
+        iteration = dlars_restart_iteration(files)
+        
+        if iteration > best[0]:
+            best = (iteration, os.path.join(path, "restart.txt" if nranks == 1 else "restart"))
+            
+    return best
+    
+    
+def read_dlars_state():
+## The DLARS_STATE record of the last run in the working directory, or None.
+
+    try:
+        with open(DLARS_STATE, "r") as statef:
+            return json.load(statef)
+    except (IOError, OSError, ValueError):
+        return None
+        
+        
+def write_dlars_state(settings, status):
+## Record the settings and status (running or finished) of a DLARS run in DLARS_STATE.
+
+    with open(DLARS_STATE, "w") as statef:
+        json.dump({ "settings" : settings, "status" : status }, statef, indent=1)
+        
+
+def fit_dlars(dlasso_dlars_path, nodes, cores, alpha, split_files, algorithm, read_output, weights, normalize, A , b, restart_dlasso_dlars, mpistyle, walltime=0.0, interval=60.0, checkpoint=0.0, resume=False):
+
+    # Use the Distributed LARS/LASSO fitting algorithm.  Returns both the solution x and
+    # the estimated force vector A * x, which is read from Ax.txt.    
+    
+    if dlasso_dlars_path == '':
+        print ("ERROR: DLARS/DLASSO  path not provided.")
+        print ("Please run again with --dlasso_dlars_path </absolute/path/to/dlars/dlasso/src/>")
+        exit(0)
+
+    if algorithm == 'dlasso' :
+        print ('! DLARS code for LASSO used')
+    elif algorithm == 'dlars' :
+        print ('! DLARS code for LARS used')
+    else:
+        print ("Bad algorithm in fit_dlars:" + algorithm)
+        exit(1)
+    print ('! DLARS alpha = %10.4e' % alpha)
+
+    if not read_output:
+    
+        dlars_file = dlasso_dlars_path + "dlars"
+        
+        if os.path.exists(dlars_file):
+	
+            # An unfinished run with the same settings (e.g. stopped by preemption or the wall-time
+            # limit) is resumed from its newest complete restart file.  A bare ibrun runs on the
+            # whole allocation, so its number of ranks is only known from the restart files.
+            
+            nranks   = 1 if mpistyle == "local" else (None if mpistyle == "ibrun" else cores)
+            settings = { "command" : dlars_command(dlars_file, [], A, b, alpha, split_files, algorithm, weights, normalize, ""), "ranks" : nranks }
+            state    = read_dlars_state()
+            resumed  = False
+            
+            if resume and restart_dlasso_dlars == "" and state is not None and state["status"] != "finished":
+            
+                if state["settings"] != settings:
+                    print ("! Unfinished DLARS run with different settings found: starting over")
+                else:
+                    (iteration, restart_file) = dlars_resume_point(nranks)
+                    
+                    if iteration > 0:
+                        print ("! Resuming unfinished DLARS run from iteration %d (%s)" % (iteration, restart_file))
+                        restart_dlasso_dlars = restart_file
+                        resumed              = True
+                    else:
+                        print ("! Unfinished DLARS run found without a complete restart file: starting over")
+                        
             if restart_dlasso_dlars != "":
                 print ("Will run a dlars/dlasso restart job with file:", restart_dlasso_dlars)
+            elif os.path.isdir(DLARS_CHECKPOINTS):
+                shutil.rmtree(DLARS_CHECKPOINTS)
 
-                command = command + " --restart=" + restart_dlasso_dlars
-                
-            command = command +  " >& dlars.log"
+            command = dlars_command(dlars_file, mpi_launcher(mpistyle, nodes, cores), A, b, alpha, split_files, algorithm, weights, normalize, restart_dlasso_dlars)
 
-            print("! DLARS run: " + command + "\n")
+            print("! DLARS run: " + " ".join(command) + " >& dlars.log\n")
+            sys.stdout.flush()
+            
+            write_dlars_state(settings, "running")
+            
+            progress = run_dlars_jobs([{ "name" : algorithm, "command" : command, "cwd" : ".", "log" : "dlars.log", 
+                                         "checkpoint" : checkpoint, "append" : resumed }], walltime, interval)[0]
 
-            if ( os.system(command) != 0 ) :
-                print(command + " failed")
+            if progress["timed_out"]:
+                print("! DLARS run stopped at the wall-time limit after iteration " + str(progress["iteration"]))
+                print("DLARS run exceeded --dlars_walltime = " + str(walltime) + " minutes. Run again to resume from the newest restart file")
                 sys.exit(1)
+                
+            if progress["returncode"] != 0 :
+                print(" ".join(command) + " failed")
+                sys.exit(1)
+                
+            write_dlars_state(settings, "finished")
+            
+            if os.path.isdir(DLARS_CHECKPOINTS):
+                shutil.rmtree(DLARS_CHECKPOINTS)
+                
+            print ("! DLARS iterations               = ", progress["iteration"])
+            print ("! DLARS active set size          = ", progress["nvars"])
+            print ("! DLARS objective fn             =  %11.4e" % progress["objective"])
+            print ("! DLARS run time (s)             =  %11.4e" % progress["elapsed"])
         else:
             print (dlars_file + " does not exist")
             sys.exit(1)
@@ -752,7 +3984,13 @@ def fit_dlars(dlasso_dlars_path, nodes, cores, alpha, split_files, algorithm, re
 
 # Python magic to allow having a main function definition.    
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except MatrixFileError as err:
+        sys.stderr.write("Error: " + str(err) + "\n")
+        exit(1)
+    except WorkerExit:
+        exit(1)
     
 
 
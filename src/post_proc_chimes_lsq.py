@@ -2,12 +2,16 @@ import sys
 
 # Parameter file post-processing .. remove zeroed-out parameters
 #
-# Usage: python <this script> <parameter file> 
+# Usage: python <this script> <parameter file> [<params.header> [<tolerance>]]
 #
 # To do:
 #
 # 1. allow zeroing of 2B parameters
 # 2. Account for the case where every interaction is set to zero
+#
+# Both are handled when the params.header of the fit is given: the parameter file is then
+# read with the header layout of chimes_lsq.py and reduced as by chimes_lsq.py --prune 
+# (parameters smaller than the tolerance, default 1.0e-06, are removed).
 
 
 class CLU_TYPE:
@@ -39,6 +43,45 @@ class CLU_TYPE:
             print("ERROR: Cluster type " + TYPE + " undefined. Exiting.")
             exit()
 
+if len(sys.argv) > 2:
+
+    import os
+    
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    
+    import chimes_lsq
+    
+    LAYOUT = chimes_lsq.load_header_layout(sys.argv[2], cache=False)
+    TOL    = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0e-06
+    
+    with open(sys.argv[1],'r') as INFILE:
+        LINES = INFILE.readlines()
+        
+    COMMENTS = [line for line in LINES if line.startswith("!")]
+    LINES    = [line for line in LINES if not line.startswith("!")]
+    
+    # The ff_groups.map lines follow the parameters, and are followed by a blank line and 
+    # the energy offsets (if any)
+    
+    KEYS      = [line.split()[0] if len(line.split()) > 0 else "" for line in LINES]
+    MAP_START = str(LAYOUT["template"]).count('\n')
+    MAP_END   = KEYS.index("NO") if "NO" in KEYS else KEYS.index("ENDFILE")
+    NVARS     = int(LAYOUT["total_params"]) + (int(LAYOUT["n_energy"]) if "NO" in KEYS else 0)
+    
+    X = chimes_lsq.read_solution(sys.argv[1], LAYOUT, NVARS)
+    
+    REDUCED, XR, NZEROED, NKEPT, NREMOVED = chimes_lsq.prune_layout(LAYOUT, X, TOL)
+    
+    with open(sys.argv[1]+".reduced",'w') as OUTFILE:
+        OUTFILE.write("".join(COMMENTS))
+        OUTFILE.write(chimes_lsq.format_params(REDUCED, XR, LINES[MAP_START:MAP_END-1]))
+        
+    print("Pair coefficients zeroed:       " + str(NZEROED))
+    print("Cluster coefficient lines kept: " + str(NKEPT))
+    print("Cluster coefficient lines cut:  " + str(NREMOVED))
+    
+    sys.exit(0)
+
 INFILE  = open(sys.argv[1],'r')  # A parameter file produced by lsq2.py script
 OUTFILE = open(sys.argv[1]+".reduced",'w') 
 
@@ -3,9 +3,10 @@
 #  
 # Before running, be sure to export hosttype=<your machine's modfile>
 # Take a look in ./modfiles to see your options. Otherwise, your machine's default modfiles will be used.
-#         run_test_suite.sh 'lsq-jobs' 'make-jobs'
+#         run_test_suite.sh 'lsq-jobs' 'make-jobs' 'solver-jobs'
 #         'lsq-jobs' is a list of lsq tests that are run by the script.  This argument may be an empty string.
 #         'make-jobs' is a list of lsq tests that are run by makefiles.  This argument may be an empty string.
+#         'solver-jobs' is a list of makefile tests of chimes_lsq.py options that do not need DLARS.
 #
 
 #######
@@ -77,9 +78,11 @@ if [ $# -eq 0 ]
 then
 	 JOBS=$LSQ_ALL_JOBS
 	 MAKE_JOBS=$LSQ_MAKE_JOBS
+	 SOLVER_JOBS=$LSQ_SOLVER_JOBS
 else
 	 JOBS=$1
 	 MAKE_JOBS=$2
+	 SOLVER_JOBS=$3
 fi
 
 
@@ -92,6 +95,10 @@ if [ ! -v hosttype ] ; then
 	MAKE_JOBS=""
 fi
 
+# Solver option tests only need the python code
+
+MAKE_JOBS="$MAKE_JOBS $SOLVER_JOBS"
+
 
 
 ###############################################################